@@ -3,10 +3,8 @@
 from __future__ import unicode_literals
 import ckan.authz as authz
 from ckan.common import _
-import ckan.lib.base as base
 
 from ckan.lib.base import render_jinja2
-from ckan.lib.mailer import mail_recipient
 from ckan.lib.mailer import MailerException
 import ckan.logic
 from ckan.logic.action.create import user_create
@@ -15,10 +13,18 @@ from ckan.logic.action.get import package_show
 from ckan.logic.action.get import resource_search
 from ckan.logic.action.get import resource_view_list
 from ckan.logic import side_effect_free
+import ckan.plugins.toolkit as toolkit
 from ckanext.restricted import auth
+from ckanext.restricted import cache
+from ckanext.restricted import jobs
 from ckanext.restricted import logic
+from ckanext.restricted import mails
+from ckanext.restricted import metrics
+from ckanext.restricted import model as restricted_model
 import json
 import copy
+import hashlib
+from functools import lru_cache
 from ckan.common import config
 
 from logging import getLogger
@@ -26,9 +32,9 @@ log = getLogger(__name__)
 
 _get_or_bust = ckan.logic.get_or_bust
 NotFound = ckan.logic.NotFound
-render = base.render
 
 
+@metrics.timed('restricted_user_create_and_notify')
 def restricted_user_create_and_notify(context, data_dict):
 
     def body_from_user_dict(user_dict):
@@ -50,15 +56,12 @@ def restricted_user_create_and_notify(context, data_dict):
         subject = _('New Registration: {0} ({1})').format(
             user_dict.get('name', _(u'new user')), user_dict.get('email'))
 
-        extra_vars = {
-            'site_title': config.get('ckan.site_title'),
-            'site_url': config.get('ckan.site_url'),
-            'user_info': body_from_user_dict(user_dict)}
+        extra_vars = {'user_info': body_from_user_dict(user_dict)}
 
-        body = render(
+        body = mails.render(
             'restricted/emails/restricted_user_registered.txt', extra_vars)
 
-        mail_recipient(name, email, subject, body)
+        jobs.enqueue_mails([jobs.mail_message(name, email, subject, body)])
 
     except MailerException as mailer_exception:
         log.error('Cannot send mail after registration')
@@ -67,6 +70,57 @@ def restricted_user_create_and_notify(context, data_dict):
     return user_dict
 
 
+@toolkit.chained_action
+def restricted_member_create(up_func, context, data_dict):
+    member = up_func(context, data_dict)
+    _invalidate_member_organizations(context, data_dict)
+    return member
+
+
+@toolkit.chained_action
+def restricted_package_update(up_func, context, data_dict):
+    # resource_create and resource_update go through package_update too,
+    # so every change of the allowed users of a resource is seen here
+    model = context['model']
+    package = model.Package.get(data_dict.get('id') or data_dict.get('name') or '')
+    previous_resources = dict(
+        (resource.id, dict(resource.extras or {})) for resource in package.resources
+    ) if package else {}
+
+    result = up_func(context, data_dict)
+
+    if isinstance(result, dict):
+        updated_resources = result.get('resources', [])
+    else:
+        # return_id_only
+        updated_resources = logic.restricted_package_resources(result)
+    grants = logic.restricted_collect_grants(
+        context.get('__restricted_grants', {}), previous_resources, updated_resources)
+    if '__restricted_grants' not in context:
+        logic.restricted_queue_notifications(grants)
+    return result
+
+
+@toolkit.chained_action
+def restricted_member_delete(up_func, context, data_dict):
+    up_func(context, data_dict)
+    _invalidate_member_organizations(context, data_dict)
+
+
+def _invalidate_member_organizations(context, data_dict):
+    if data_dict.get('object_type') != 'user':
+        return
+    model = context['model']
+    user_obj = model.User.get(data_dict.get('object'))
+    if user_obj:
+        cache.invalidate_user_organizations(user_obj.name, user_obj.id)
+    else:
+        cache.invalidate_user_organizations(data_dict.get('object'))
+    # the capacity of the user in the organization might have changed
+    cache.request_cache('package_update').clear()
+    cache.invalidate_decisions()
+
+
 @side_effect_free
 def restricted_resource_view_list(context, data_dict):
     model = context['model']
@@ -75,7 +129,7 @@ def restricted_resource_view_list(context, data_dict):
     if not resource:
         raise NotFound
     authorized = auth.restricted_resource_show(
-        context, {'id': resource.get('id'), 'resource': resource}).get('success', False)
+        context, {'id': resource.id, 'resource': resource}).get('success', False)
     if not authorized:
         return []
     else:
@@ -83,27 +137,12 @@ def restricted_resource_view_list(context, data_dict):
 
 
 @side_effect_free
+@metrics.timed('restricted_package_show')
 def restricted_package_show(context, data_dict):
 
     package_metadata = package_show(context, data_dict)
 
-    # Ensure user who can edit can see the resource
-    if authz.is_authorized(
-            'package_update', context, package_metadata).get('success', False):
-        return package_metadata
-
-    # Custom authorization
-    if isinstance(package_metadata, dict):
-        restricted_package_metadata = dict(package_metadata)
-    else:
-        restricted_package_metadata = dict(package_metadata.for_json())
-
-    # restricted_package_metadata['resources'] = _restricted_resource_list_url(
-    #     context, restricted_package_metadata.get('resources', []))
-    restricted_package_metadata['resources'] = _restricted_resource_list_hide_fields(
-        context, restricted_package_metadata.get('resources', []))
-
-    return restricted_package_metadata
+    return _restricted_package_hide_fields(context, package_metadata)
 
 
 @side_effect_free
@@ -125,20 +164,21 @@ def restricted_resource_search(context, data_dict):
 
 
 @side_effect_free
+@metrics.timed('restricted_package_search')
 def restricted_package_search(context, data_dict):
-    package_search_result = package_search(context, data_dict)
+    package_search_result = package_search(
+        context, _restricted_strip_search_fields(data_dict))
 
     restricted_package_search_result = {}
 
-    package_show_context = context.copy()
-    package_show_context['with_capacity'] = False
-
     for key, value in package_search_result.items():
         if key == 'results':
+            # mask the packages returned by the search in place instead of
+            # loading every one of them again with package_show
             restricted_package_search_result_list = []
             for package in value:
                 restricted_package_search_result_list.append(
-                    restricted_package_show(package_show_context, {'id': package.get('id')}))
+                    _restricted_package_hide_fields(context, package))
             restricted_package_search_result[key] = \
                 restricted_package_search_result_list
         else:
@@ -146,6 +186,38 @@ def restricted_package_search(context, data_dict):
 
     return restricted_package_search_result
 
+def _restricted_is_hidden_search_field(field):
+    # the indexed restricted values and the stored package dicts are not
+    # masked, wildcards could match them
+    return '*' in field or field in ('restricted', 'data_dict', 'validated_data_dict') \
+        or field.startswith('vocab_restricted_') or field.startswith('res_extras_restricted')
+
+
+def _restricted_strip_search_fields(data_dict):
+    fl = data_dict.get('fl')
+    facet_field = data_dict.get('facet.field')
+    if not fl and not facet_field:
+        return data_dict
+
+    data_dict = dict(data_dict)
+    if fl:
+        fields = fl.replace(',', ' ').split() if isinstance(fl, str) else fl
+        data_dict['fl'] = [field for field in fields
+                           if not _restricted_is_hidden_search_field(field)]
+    if facet_field:
+        fields = facet_field
+        if isinstance(facet_field, str):
+            try:
+                fields = json.loads(facet_field)
+            except ValueError:
+                raise ckan.logic.ValidationError({'facet.field': ['Invalid JSON list']})
+        if not isinstance(fields, list):
+            raise ckan.logic.ValidationError({'facet.field': ['Must be a list']})
+        data_dict['facet.field'] = [field for field in fields
+                                    if not _restricted_is_hidden_search_field(field)]
+    return data_dict
+
+
 @side_effect_free
 def restricted_check_access(context, data_dict):
 
@@ -161,12 +233,435 @@ def restricted_check_access(context, data_dict):
 
     log.debug("action.restricted_check_access: user_name = " + str(user_name))
 
-    log.debug("checking package " + str(package_id))
-    package_dict = ckan.logic.get_action('package_show')(dict(context, return_type='dict'), {'id': package_id})
-    log.debug("checking resource")
-    resource_dict = ckan.logic.get_action('resource_show')(dict(context, return_type='dict'), {'id': resource_id})
+    # the resource, its dataset and the policy in one query instead of
+    # package_show and resource_show
+    row = restricted_model.get_resource_with_package(resource_id, package_id)
+    if row is None:
+        raise NotFound('Resource not found')
+    resource, package = row
+
+    if package.private:
+        ckan.logic.check_access(
+            'package_show', dict(context, package=package), {'id': package.id})
+
+    # the token changes with the policy, the dataset and, only when the
+    # answer depends on them, the organizations of the user, so an
+    # unchanged one is answered before the access checks
+    resource_dict = dict(resource.extras or {}, id=resource.id)
+    policy = logic.restricted_get_restricted_policy(resource_dict)
+    organization_ids = []
+    if user_name and user_name not in policy.allowed_users and \
+            policy.level not in (logic.RestrictedLevel.PUBLIC,
+                                 logic.RestrictedLevel.REGISTERED,
+                                 logic.RestrictedLevel.ONLY_ALLOWED_USERS):
+        organization_ids = sorted(cache.get_user_organizations(
+            user_name, logic.restricted_get_user_organizations))
+    token = hashlib.sha1(json.dumps([
+        user_name, resource.id, policy.level_name, policy.users,
+        package.id, package.owner_org, package.private, organization_ids
+    ], default=str).encode('utf-8')).hexdigest()
+    if data_dict.get('if_none_match') == token:
+        return {'token': token, 'not_modified': True}
+
+    decision = logic.restricted_check_user_resource_access(
+        user_name, resource_dict, {'id': package.id, 'owner_org': package.owner_org})
+    # like resource_show, only the editors get an answer when denied
+    if not decision.get('success') and \
+            not logic.restricted_user_can_edit_package(context, package.id):
+        raise ckan.logic.NotAuthorized(decision.get('msg', ''))
+    return dict(decision, token=token)
+
+
+@side_effect_free
+def restricted_check_access_batch(context, data_dict):
+    model = context['model']
+    resource_ids = data_dict.get('resource_ids', [])
+    if isinstance(resource_ids, str):
+        resource_ids = resource_ids.split(',')
+    resource_ids = [id.strip() for id in resource_ids if id and id.strip()]
+
+    if not resource_ids:
+        raise ckan.logic.ValidationError('Missing resource_ids')
+
+    user_name = logic.restricted_get_username_from_context(context)
+
+    log.debug("action.restricted_check_access_batch: user_name = " + str(user_name))
+
+    resources = model.Session.query(model.Resource).filter(
+        model.Resource.id.in_(resource_ids),
+        model.Resource.state == model.State.ACTIVE).all()
+    resources = dict((resource.id, resource.as_dict()) for resource in resources)
+
+    package_ids = set(resource['package_id'] for resource in resources.values())
+    packages = {}
+    for package in model.Session.query(model.Package).filter(
+            model.Package.id.in_(package_ids)):
+        # the package object is reused by the auth function
+        package_context = dict(context, package=package)
+        if authz.is_authorized(
+                'package_show', package_context, {'id': package.id}).get('success'):
+            packages[package.id] = {'id': package.id, 'owner_org': package.owner_org}
+
+    result = {}
+    for resource_id in resource_ids:
+        resource_dict = resources.get(resource_id)
+        if not resource_dict:
+            result[resource_id] = {
+                'success': False, 'msg': 'Resource not found'}
+            continue
+        package_dict = packages.get(resource_dict['package_id'])
+        if not package_dict:
+            result[resource_id] = {
+                'success': False, 'msg': 'Not authorized to read dataset'}
+            continue
+        result[resource_id] = logic.restricted_check_user_resource_access(
+            user_name, resource_dict, package_dict)
+
+    return result
+
+
+@side_effect_free
+def restricted_accessible_resource_list(context, data_dict):
+    model = context['model']
+    ckan.logic.check_access(
+        'restricted_accessible_resource_list', context, data_dict)
+
+    user_name = data_dict.get('user') or \
+        logic.restricted_get_username_from_context(context)
+    user_obj = model.User.get(user_name) if user_name else None
+    if user_name and not user_obj:
+        raise NotFound('User not found')
+    if not restricted_model.tables_exist():
+        raise ckan.logic.ValidationError(
+            'Access index missing, run "ckan restricted init-db"')
+
+    limit = _restricted_int_param(data_dict, 'limit', 100, 1, 1000)
+    offset = _restricted_int_param(data_dict, 'offset', 0, 0)
+    restricted_only = not toolkit.asbool(data_dict.get('include_public', False))
+
+    query = restricted_model.accessible_resources_query(user_obj, restricted_only)
+    return {
+        'count': query.count(),
+        'results': [row[0] for row in query.offset(offset).limit(limit)]}
+
+
+@side_effect_free
+def restricted_resources_for_user(context, data_dict):
+    """List the resources a user was given access to as allowed user."""
+    model = context['model']
+    ckan.logic.check_access('restricted_resources_for_user', context, data_dict)
+
+    user_name = data_dict.get('user') or \
+        logic.restricted_get_username_from_context(context)
+    user_obj = model.User.get(user_name) if user_name else None
+    if not user_obj:
+        raise NotFound('User not found')
+    if not restricted_model.tables_exist():
+        raise ckan.logic.ValidationError(
+            'Access index missing, run "ckan restricted init-db"')
+
+    limit = _restricted_int_param(data_dict, 'limit', 100, 1, 1000)
+    offset = _restricted_int_param(data_dict, 'offset', 0, 0)
+
+    query = restricted_model.allowed_user_resources_query(user_obj.name)
+    return {
+        'count': query.count(),
+        'results': [{
+            'id': resource_id, 'package_id': package_id,
+            'level': level, 'name': name}
+            for resource_id, package_id, level, name
+            in query.offset(offset).limit(limit)]}
+
+
+def _restricted_int_param(data_dict, name, default, minimum, maximum=None):
+    """Return the integer parameter `name` of `data_dict`, raise a
+    ValidationError if it is not a number between minimum and maximum.
+    """
+    try:
+        value = toolkit.get_validator('int_validator')(
+            data_dict.get(name, default), {})
+    except toolkit.Invalid as e:
+        raise ckan.logic.ValidationError({name: [e.error]})
+    if value is None:
+        value = default
+    if value < minimum or (maximum is not None and value > maximum):
+        if maximum is None:
+            message = 'Must be at least {}'.format(minimum)
+        else:
+            message = 'Must be between {} and {}'.format(minimum, maximum)
+        raise ckan.logic.ValidationError({name: [message]})
+    return value
+
 
-    return logic.restricted_check_user_resource_access(user_name, resource_dict, package_dict)
+@side_effect_free
+def restricted_package_export(context, data_dict):
+    """Page through the datasets visible to a user, masked like
+    package_show. Pass the returned `next_after` as `after` to get the
+    next page, it is None on the last page.
+    """
+    ckan.logic.check_access('restricted_package_export', context, data_dict)
+
+    limit = _restricted_int_param(data_dict, 'limit', 100, 1, 1000)
+    user_name = data_dict.get('user') or \
+        logic.restricted_get_username_from_context(context)
+    results = list(restricted_iter_package_export(
+        context['model'], user_name, after=data_dict.get('after'), limit=limit))
+    return {
+        'results': results,
+        'next_after': results[-1]['id'] if len(results) == limit else None}
+
+
+def restricted_iter_package_export(model, user_name, after=None, limit=None,
+                                   batch_size=100):
+    """Return an iterator over the datasets visible to `user_name`.
+
+    The ids are read with a server side cursor and every dataset is
+    shown and masked when it is consumed, so the memory used does not
+    grow with the size of the catalog. Without a `limit` all of them are
+    returned, only for the CLI and the streamed export.
+    """
+    user_obj = model.User.get(user_name) if user_name else None
+    if user_name and not user_obj:
+        raise NotFound('User not found')
+    user_name = user_obj.name if user_obj else ''
+    organization_ids = list(cache.get_user_organizations(
+        user_name, logic.restricted_get_user_organizations)) if user_obj else []
+
+    query = restricted_model.visible_packages_query(
+        user_obj, organization_ids, after)
+    if limit is not None:
+        query = query.limit(limit)
+    return _restricted_iter_package_export(
+        model, query, user_name, user_obj, batch_size)
+
+
+def _restricted_iter_package_export(model, query, user_name, user_obj, batch_size):
+    for index, (package_id,) in enumerate(query.yield_per(batch_size)):
+        if index and not index % batch_size:
+            cache.reset_request_caches()
+        # visibility is checked by the query, the resources are masked
+        # for the user below
+        package_dict = package_show(
+            {'model': model, 'session': model.Session, 'ignore_auth': True,
+             'user': user_name},
+            {'id': package_id})
+        yield _restricted_package_hide_fields(
+            {'model': model, 'session': model.Session, 'user': user_name,
+             'auth_user_obj': user_obj},
+            package_dict)
+
+
+def restricted_allowed_users_patch(context, data_dict):
+    model = context['model']
+
+    def _as_list(value):
+        if isinstance(value, str):
+            value = value.split(',')
+        return [item.strip() for item in value or [] if item and item.strip()]
+
+    resource_ids = set(_as_list(data_dict.get('resource_ids')))
+    package_id = data_dict.get('package_id')
+    add_users = _as_list(data_dict.get('add'))
+    remove_users = set(_as_list(data_dict.get('remove')))
+
+    if not resource_ids and not package_id:
+        raise ckan.logic.ValidationError('Missing resource_ids or package_id')
+    if not add_users and not remove_users:
+        raise ckan.logic.ValidationError('Missing add or remove')
+
+    # group the resources by package
+    package_resource_ids = {}
+    if resource_ids:
+        query = model.Session.query(model.Resource.id, model.Resource.package_id).filter(
+            model.Resource.id.in_(resource_ids),
+            model.Resource.state == model.State.ACTIVE)
+        for resource_id, resource_package_id in query:
+            package_resource_ids.setdefault(resource_package_id, set()).add(resource_id)
+        missing = resource_ids - set().union(*package_resource_ids.values())
+        if missing:
+            raise NotFound('Resources not found: {}'.format(', '.join(sorted(missing))))
+    if package_id:
+        package = model.Package.get(package_id)
+        if not package:
+            raise NotFound('Dataset not found')
+        package_resource_ids[package.id] = None
+
+    update_context = dict(context, defer_commit=True)
+    updated_resources = []
+    grants = {}
+    try:
+        for pkg_id, pkg_resource_ids in package_resource_ids.items():
+            ckan.logic.check_access('package_update', context, {'id': pkg_id})
+
+            pkg_dict = package_show(dict(context), {'id': pkg_id})
+            changed_resource_ids = []
+            for resource in pkg_dict.get('resources', []):
+                if pkg_resource_ids is not None and resource['id'] not in pkg_resource_ids:
+                    continue
+                if _restricted_patch_allowed_users(resource, add_users, remove_users):
+                    changed_resource_ids.append(resource['id'])
+
+            if not changed_resource_ids:
+                continue
+
+            # package_update adds the new allowed users to grants, diffed
+            # against the saved values where emails are replaced by user names
+            ckan.logic.get_action('package_update')(
+                dict(update_context, __restricted_grants=grants), pkg_dict)
+            updated_resources.extend(changed_resource_ids)
+
+        model.repo.commit()
+    except Exception:
+        model.Session.rollback()
+        raise
+
+    logic.restricted_queue_notifications(grants)
+
+    return {'updated_resources': updated_resources,
+            'notified_users': sorted(grants.keys())}
+
+
+@side_effect_free
+def restricted_access_request_list(context, data_dict):
+    model = context['model']
+    ckan.logic.check_access('restricted_access_request_list', context, data_dict)
+    _restricted_check_access_request_table()
+
+    filters = {}
+    if data_dict.get('package_id'):
+        package = model.Package.get(data_dict['package_id'])
+        if not package:
+            raise NotFound('Dataset not found')
+        filters['package_id'] = package.id
+    if data_dict.get('resource_id'):
+        filters['resource_id'] = data_dict['resource_id']
+    if data_dict.get('user'):
+        user_obj = model.User.get(data_dict['user'])
+        if not user_obj:
+            raise NotFound('User not found')
+        filters['user_id'] = user_obj.id
+    if data_dict.get('status'):
+        if data_dict['status'] not in restricted_model.ACCESS_REQUEST_STATUSES:
+            raise ckan.logic.ValidationError({'status': ['Invalid status']})
+        filters['status'] = data_dict['status']
+
+    limit = _restricted_int_param(data_dict, 'limit', 20, 1, 1000)
+    offset = _restricted_int_param(data_dict, 'offset', 0, 0)
+
+    count, results = restricted_model.list_access_requests(filters, limit, offset)
+    return {'count': count, 'results': results}
+
+
+def restricted_access_request_approve(context, data_dict):
+    model = context['model']
+    access_request = _restricted_get_access_request(context, data_dict)
+    ckan.logic.check_access(
+        'package_update', context, {'id': access_request['package_id']})
+
+    user_obj = model.User.get(access_request['user_id'])
+    if not user_obj:
+        raise NotFound('User not found')
+
+    # committed together with the allowed users
+    restricted_model.set_access_request_status(access_request['id'], 'approved')
+    restricted_allowed_users_patch(context, {
+        'resource_ids': [access_request['resource_id']],
+        'add': [user_obj.name]})
+    # nothing is committed if the user was already allowed
+    model.repo.commit()
+
+    return restricted_model.get_access_request(access_request['id'])
+
+
+def restricted_access_request_reject(context, data_dict):
+    model = context['model']
+    access_request = _restricted_get_access_request(context, data_dict)
+    ckan.logic.check_access(
+        'package_update', context, {'id': access_request['package_id']})
+
+    restricted_model.set_access_request_status(access_request['id'], 'rejected')
+    model.repo.commit()
+
+    return restricted_model.get_access_request(access_request['id'])
+
+
+def _restricted_check_access_request_table():
+    if not restricted_model.table_exists(restricted_model.access_request_table):
+        raise ckan.logic.ValidationError(
+            'Access request table missing, run "ckan restricted init-db"')
+
+
+def _restricted_get_access_request(context, data_dict):
+    _restricted_check_access_request_table()
+    access_request = restricted_model.get_access_request(
+        _get_or_bust(data_dict, 'id'))
+    if not access_request:
+        raise NotFound('Access request not found')
+    if access_request['status'] != 'pending':
+        raise ckan.logic.ValidationError(
+            {'status': ['Access request is already {}'.format(access_request['status'])]})
+    return access_request
+
+
+def _restricted_patch_allowed_users(resource, add_users, remove_users):
+    """Add and remove allowed users of a resource dict in place, return
+    True if they changed. The stored names are compared stripped, like
+    the access checks do.
+    """
+    policy = logic.restricted_get_restricted_policy(resource)
+    stored_users = [user.strip() for user in policy.users if user.strip()]
+    users = [user for user in stored_users if user not in remove_users]
+    for user in add_users:
+        if user not in users:
+            users.append(user)
+    if users == stored_users:
+        return False
+    _restricted_set_allowed_users(resource, users)
+    return True
+
+
+def _restricted_set_allowed_users(resource, users):
+    # keep the other values of the restricted field and its format
+    extras = resource.get('extras', {})
+    restricted = resource.get('restricted', extras.get('restricted', {}))
+    as_string = not isinstance(restricted, dict)
+    if as_string:
+        try:
+            restricted = json.loads(restricted or '{}')
+        except ValueError:
+            restricted = {}
+        if not isinstance(restricted, dict):
+            restricted = {}
+    restricted = dict(restricted)
+    restricted.setdefault('level', 'public')
+    restricted['allowed_users'] = ','.join(users)
+    if as_string:
+        restricted = json.dumps(restricted)
+
+    if 'restricted' not in resource and 'restricted' in extras:
+        resource['extras'] = dict(extras, restricted=restricted)
+    else:
+        resource['restricted'] = restricted
+
+
+def _restricted_package_hide_fields(context, package_metadata):
+    # Custom authorization
+    if isinstance(package_metadata, dict):
+        restricted_package_metadata = dict(package_metadata)
+    else:
+        restricted_package_metadata = dict(package_metadata.for_json())
+
+    # Ensure user who can edit can see the resource
+    if logic.restricted_user_can_edit_package(
+            context, restricted_package_metadata.get('id')):
+        return package_metadata
+
+    # restricted_package_metadata['resources'] = _restricted_resource_list_url(
+    #     context, restricted_package_metadata.get('resources', []))
+    restricted_package_metadata['resources'] = _restricted_resource_list_hide_fields(
+        context, restricted_package_metadata.get('resources', []))
+
+    return restricted_package_metadata
 
 # def _restricted_resource_list_url(context, resource_list):
 #     restricted_resources_list = []
@@ -180,45 +675,63 @@ def restricted_check_access(context, data_dict):
 #     return restricted_resources_list
 
 def _restricted_resource_list_hide_fields(context, resource_list):
+    user_name = logic.restricted_get_username_from_context(context)
+    can_edit_package = {}
+
     restricted_resources_list = []
     for resource in resource_list:
-        # copy original resource
+        # hide other fields in restricted to everyone but dataset owner(s)
+        package_id = resource.get('package_id')
+        if package_id not in can_edit_package:
+            can_edit_package[package_id] = logic.restricted_user_can_edit_package(
+                context, package_id)
+        if can_edit_package[package_id]:
+            restricted_resources_list.append(resource)
+        else:
+            restricted_resources_list.append(
+                _restricted_resource_hide_fields(resource, user_name))
+    return restricted_resources_list
+
+
+def _restricted_resource_hide_fields(resource, user_name):
+    # the resource is only copied if the restricted value changes
+    extras_restricted = resource.get('extras', {}).get('restricted', {})
+    field_restricted_field = resource.get('restricted', {})
+    if not extras_restricted and not field_restricted_field:
+        return resource
+
+    # get the restricted fields
+    policy = logic.restricted_get_restricted_policy(resource)
+    new_restricted = _restricted_mask_policy(policy, user_name)
+
+    restricted_resource = resource
+    if extras_restricted and extras_restricted != new_restricted:
         restricted_resource = dict(resource)
+        restricted_resource['extras'] = dict(
+            resource['extras'], restricted=new_restricted)
 
-        # get the restricted fields
-        restricted_dict = logic.restricted_get_restricted_dict(restricted_resource)
+    if field_restricted_field and field_restricted_field != new_restricted:
+        if restricted_resource is resource:
+            restricted_resource = dict(resource)
+        restricted_resource['restricted'] = new_restricted
 
-        # hide fields to unauthorized users
-        authorized = auth.restricted_resource_show(
-            context, {'id': resource.get('id'), 'resource': resource}
-            ).get('success', False)
+    return restricted_resource
 
-        # hide other fields in restricted to everyone but dataset owner(s)
-        if not authz.is_authorized(
-                'package_update', context, {'id': resource.get('package_id')}
-                ).get('success'):
-
-            user_name = logic.restricted_get_username_from_context(context)
-
-            # hide partially other allowed user_names (keep own)
-            allowed_users = []
-            for user in restricted_dict.get('allowed_users'):
-                if len(user.strip()) > 0:
-                    if user_name == user:
-                        allowed_users.append(user_name)
-                    else:
-                        allowed_users.append(user[0:3] + '*****' + user[-2:])
-
-            new_restricted = json.dumps({
-                'level': restricted_dict.get("level"),
-                'allowed_users': ','.join(allowed_users)})
-            extras_restricted = resource.get('extras', {}).get('restricted', {})
-            if (extras_restricted):
-                restricted_resource['extras']['restricted'] = new_restricted
-
-            field_restricted_field = resource.get('restricted', {})
-            if (field_restricted_field):
-                restricted_resource['restricted'] = new_restricted
-
-        restricted_resources_list += [restricted_resource]
-    return restricted_resources_list
+
+@lru_cache(maxsize=4096)
+def _restricted_mask_policy(policy, user_name):
+    # hide partially other allowed user_names (keep own)
+    allowed_users = []
+    for user in policy.users:
+        if len(user.strip()) > 0:
+            if user_name == user:
+                allowed_users.append(user_name)
+            else:
+                allowed_users.append(user[0:3] + '*****' + user[-2:])
+
+    return json.dumps({
+        'level': policy.level_name,
+        'allowed_users': ','.join(allowed_users)})
+
+
+metrics.register_lru_cache('policy_mask', _restricted_mask_policy)
@@ -1,16 +1,18 @@
 # coding: utf8
 
 from __future__ import unicode_literals
-import ckan.authz as authz
 import ckan.logic.auth as logic_auth
 import ckan.plugins.toolkit as toolkit
+from ckanext.restricted import cache
 from ckanext.restricted import logic
+from ckanext.restricted import metrics
 
 from logging import getLogger
 log = getLogger(__name__)
 
 
 @toolkit.auth_allow_anonymous_access
+@metrics.timed('restricted_resource_show')
 def restricted_resource_show(context, data_dict=None):
 
     # Ensure user who can edit the package can see the resource
@@ -20,18 +22,83 @@ def restricted_resource_show(context, data_dict=None):
     if type(resource) is not dict:
         resource = resource.as_dict()
 
-    if authz.is_authorized(
-            'package_update', context,
-            {'id': resource.get('package_id')}).get('success'):
-        return ({'success': True})
+    # resource_view_list and resource_view_show check the same resource
+    # again for every view
+    decision, level = cache.get_resource_decision(
+        (context.get('user'), resource.get('id'),
+         resource.get('metadata_modified'), resource.get('package_id')),
+        lambda key: _restricted_resource_show(context, data_dict, resource))
+    metrics.decisions.inc(
+        level=level, outcome='allowed' if decision.get('success') else 'denied')
+    return decision
+
+
+def _restricted_resource_show(context, data_dict, resource):
+    """Return the decision and the level it was taken for."""
+    if logic.restricted_user_can_edit_package(
+            context, resource.get('package_id')):
+        return {'success': True}, 'editor'
 
     user_name = logic.restricted_get_username_from_context(context)
 
+    # only owner_org is needed from the package
     package = data_dict.get('package', {})
     if not package:
-        model = context['model']
-        package = model.Package.get(resource.get('package_id'))
-        package = package.as_dict()
+        package_id = resource.get('package_id')
+        package_obj = context.get('package')
+        if package_obj is not None and \
+                getattr(package_obj, 'id', None) == package_id:
+            owner_org = package_obj.owner_org
+        else:
+            owner_org = logic.restricted_get_package_owner_org(package_id)
+        package = {'id': package_id, 'owner_org': owner_org}
+
+    decision = logic.restricted_check_user_resource_access(
+        user_name, resource, package)
+    policy = logic.restricted_get_restricted_policy(resource)
+    return decision, policy.level.value if policy.level else 'unknown'
+
+
+def restricted_accessible_resource_list(context, data_dict):
+    # users can list their own resources, sysadmins anyone's
+    user_name = logic.restricted_get_username_from_context(context)
+    if not user_name:
+        return {'success': False}
+    requested_user = data_dict.get('user')
+    if requested_user and requested_user != user_name:
+        user_obj = context['model'].User.get(requested_user)
+        if not user_obj or user_obj.name != user_name:
+            return {'success': False}
+    return {'success': True}
+
 
-    return (logic.restricted_check_user_resource_access(
-        user_name, resource, package))
+def restricted_resources_for_user(context, data_dict):
+    return restricted_accessible_resource_list(context, data_dict)
+
+
+@toolkit.auth_allow_anonymous_access
+def restricted_package_export(context, data_dict):
+    # everyone can export what they can see, sysadmins for any user
+    if not data_dict.get('user'):
+        return {'success': True}
+    return restricted_accessible_resource_list(context, data_dict)
+
+
+def restricted_access_request_list(context, data_dict):
+    # the dataset editors can list the requests of their dataset,
+    # users their own requests, sysadmins all of them
+    model = context['model']
+    package_id = data_dict.get('package_id')
+    if not package_id and data_dict.get('resource_id'):
+        resource = model.Resource.get(data_dict['resource_id'])
+        package_id = resource.package_id if resource else None
+    if package_id and logic.restricted_user_can_edit_package(context, package_id):
+        return {'success': True}
+
+    user_name = logic.restricted_get_username_from_context(context)
+    requested_user = data_dict.get('user')
+    if user_name and requested_user:
+        user_obj = model.User.get(requested_user)
+        if user_obj and user_obj.name == user_name:
+            return {'success': True}
+    return {'success': False}
@@ -1,6 +1,7 @@
 # coding: utf8
 
 from __future__ import unicode_literals
+import ckan.authz as authz
 from ckan.common import _, g, config
 import ckan.lib.base as base
 import ckan.lib.captcha as captcha
@@ -10,11 +11,19 @@ import ckan.lib.navl.dictization_functions as dictization_functions
 import ckan.logic as logic
 import ckan.model as model
 import ckan.plugins.toolkit as toolkit
-from jinja2 import Environment
+from ckanext.restricted import action
+from ckanext.restricted import cache
+from ckanext.restricted import jobs
+from ckanext.restricted import mails
+from ckanext.restricted import metrics
+from ckanext.restricted import model as restricted_model
+import hmac
 import os
+from redis.exceptions import RedisError
 import simplejson as json
+from sqlalchemy.exc import IntegrityError
 
-from flask import Blueprint, request, render_template
+from flask import Blueprint, Response, request, render_template, stream_with_context
 
 
 from logging import getLogger
@@ -26,6 +35,9 @@ unflatten = dictization_functions.unflatten
 
 render = base.render
 
+# (package id, metadata_modified) -> contact details
+_contact_details_cache = cache.TTLCache(ttl=3600, maxsize=1000)
+
 
 def get_blueprints(name, module):
     # Create Blueprint for plugin
@@ -38,9 +50,68 @@ def get_blueprints(name, module):
         methods=[u'GET', u'POST']
     )
 
+    blueprint.add_url_rule(
+        u"/restricted/metrics",
+        u"restricted_metrics",
+        restricted_metrics,
+        methods=[u'GET']
+    )
+
+    blueprint.add_url_rule(
+        u"/restricted/export.jsonl",
+        u"restricted_package_export",
+        restricted_package_export,
+        methods=[u'GET']
+    )
+
     return blueprint
 
 
+def restricted_package_export():
+    """Stream the datasets visible to the current user as JSON lines."""
+    # the whole catalog is streamed, anonymous callers can page through
+    # the public datasets with the restricted_package_export action
+    if not g.user:
+        toolkit.abort(401, _('The export is available to logged in users only.'))
+    context = {'model': model, 'session': model.Session,
+               'user': g.user, 'auth_user_obj': g.userobj}
+    data_dict = {'user': request.args.get('user', '')}
+    try:
+        logic.check_access('restricted_package_export', context, data_dict)
+        packages = action.restricted_iter_package_export(
+            model, data_dict['user'] or g.user)
+    except logic.NotAuthorized:
+        toolkit.abort(403, _('Unauthorized to export the datasets'))
+    except logic.NotFound:
+        toolkit.abort(404, _('User not found'))
+
+    def generate():
+        for package_dict in packages:
+            yield json.dumps(package_dict) + '\n'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
+def restricted_metrics():
+    """Prometheus metrics of all the CKAN processes, for sysadmins or
+    the scrapers sending the configured bearer token.
+    """
+    if not metrics.enabled:
+        base.abort(404)
+    authorization = request.headers.get('Authorization', '')
+    if not (metrics.token and hmac.compare_digest(
+            authorization, 'Bearer {}'.format(metrics.token))) and \
+            not authz.is_sysadmin(g.user):
+        base.abort(403, _('Not authorized to see this page'))
+    try:
+        body = metrics.render()
+    except RedisError as e:
+        log.warning('Cannot read the metrics from Redis: %s', e)
+        base.abort(503, _('Metrics not available'))
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+
 def restricted_request_access_form(package_id, resource_id, data=None, errors=None, error_summary=None):
     """Redirects to form."""
     try:
@@ -77,17 +148,17 @@ def restricted_request_access_form(package_id, resource_id, data=None, errors=No
             data['user_name'] = user.get('display_name', user_id)
             data['user_email'] = user.get('email', '')
 
-            resource_name = ''
-
-            pkg = toolkit.get_action('package_show')(context, {'id': package_id})
+            pkg = _get_package_summary(context, package_id)
             data['package_name'] = pkg.get('name')
-            resources = pkg.get('resources', [])
-            for resource in resources:
-                if resource['id'] == resource_id:
-                    resource_name = resource['name']
-                    break
-            else:
+            resource = model.Session.query(
+                model.Resource.id, model.Resource.name).filter(
+                model.Resource.id == resource_id,
+                model.Resource.package_id == pkg['id'],
+                model.Resource.state == model.State.ACTIVE).first()
+            if resource is None:
                 toolkit.abort(404, 'Dataset resource not found')
+            # resources can have no name
+            resource_name = resource.name or ''
             # get mail
             contact_details = _get_contact_details(pkg)
         except toolkit.ObjectNotFound:
@@ -112,38 +183,29 @@ def restricted_request_access_form(package_id, resource_id, data=None, errors=No
         extra_vars=extra_vars)
 
 
+@metrics.timed('_send_request_mail')
 def _send_request_mail(data):
     success = False
     try:
 
-        resource_link = toolkit.url_for(
-            action='read',
-            controller='dataset_resource',
-            id=data.get('package_name'),
-            resource_id=data.get('resource_id'))
-
-        resource_edit_link = toolkit.url_for(
-            action='edit',
-            controller='dataset_resource',
-            id=data.get('package_name'),
-            resource_id=data.get('resource_id'))
+        resource_link = mails.resource_url(
+            data.get('package_name'), data.get('resource_id'))
+        resource_edit_link = mails.resource_url(
+            data.get('package_name'), data.get('resource_id'), action='edit')
 
         extra_vars = {
-            'site_title': config.get('ckan.site_title'),
-            'site_url': config.get('ckan.site_url'),
             'maintainer_name': data.get('maintainer_name', 'Maintainer'),
             'user_id': data.get('user_id', 'the user id'),
             'user_name': data.get('user_name', ''),
             'user_email': data.get('user_email', ''),
             'resource_name': data.get('resource_name', ''),
-            'resource_link': config.get('ckan.site_url') + resource_link,
-            'resource_edit_link': config.get('ckan.site_url') + resource_edit_link,
+            'resource_link': resource_link,
+            'resource_edit_link': resource_edit_link,
             'package_name': data.get('resource_name', ''),
-            'message': data.get('message', ''),
-            'admin_email_to': config.get('email_to', 'email_to_undefined')}
+            'message': data.get('message', '')}
 
         mail_template = 'restricted/emails/restricted_access_request.txt'
-        body = render(mail_template, extra_vars)
+        body = mails.render(mail_template, extra_vars)
 
         subject = \
             _('Access Request to resource {0} ({1}) from {2}').format(
@@ -151,34 +213,40 @@ def _send_request_mail(data):
                 data.get('package_name', ''),
                 data.get('user_name', ''))
 
+        site_title = config.get('ckan.site_title')
+        admin_email_to = config.get('email_to', 'email_to_undefined')
         email_dict = {
             data.get('maintainer_email'): extra_vars.get('maintainer_name'),
-            extra_vars.get('admin_email_to'): '{} Admin'.format(extra_vars.get('site_title'))}
+            admin_email_to: '{} Admin'.format(site_title)}
 
         headers = {
             'CC': ",".join(email_dict.keys()),
             'reply-to': data.get('user_email')}
 
         # CC doesn't work and mailer cannot send to multiple addresses
+        messages = []
         for email, name in email_dict.items():
-            mailer.mail_recipient(recipient_name=name, recipient_email=email, subject='Fwd: ' + subject, body=body,
-                                  body_html=None, headers=headers)
+            messages.append(jobs.mail_message(
+                recipient_name=name, recipient_email=email,
+                subject='Fwd: ' + subject, body=body, headers=headers))
 
         # Special copy for the user (no links)
         email = data.get('user_email')
         name = data.get('user_name', 'User')
 
-        extra_vars['resource_link'] = '[...]'
-        extra_vars['resource_edit_link'] = '[...]'
-        body = render('restricted/emails/restricted_access_request.txt', extra_vars)
+        body = body.replace(resource_edit_link, '[...]').replace(
+            resource_link, '[...]')
 
         body_user = _(
             'Please find below a copy of the access '
             'request mail sent. \n\n >> {}'
         ).format(body.replace("\n", "\n >> "))
 
-        mailer.mail_recipient(recipient_name=name, recipient_email=email, subject='Fwd: ' + subject, body=body_user,
-                              body_html=None, headers=headers)
+        messages.append(jobs.mail_message(
+            recipient_name=name, recipient_email=email,
+            subject='Fwd: ' + subject, body=body_user, headers=headers))
+
+        jobs.enqueue_mails(messages)
         success = True
 
     except mailer.MailerException as mailer_exception:
@@ -206,8 +274,7 @@ def _send_request(context):
             data=data_dict)
 
     try:
-        pkg = toolkit.get_action('package_show')(
-            context, {'id': data_dict.get('package_name')})
+        pkg = _get_package_summary(context, data_dict.get('package_name'))
         data_dict['pkg_dict'] = pkg
     except toolkit.ObjectNotFound:
         toolkit.abort(404, _('Dataset not found'))
@@ -231,14 +298,95 @@ def _send_request(context):
             package_id=data_dict.get('package-name'),
             resource_id=data_dict.get('resource'))
 
+    # the resource must belong to the dataset
+    resource_exists = model.Session.query(model.Resource.id).filter(
+        model.Resource.id == data_dict.get('resource_id'),
+        model.Resource.package_id == pkg['id'],
+        model.Resource.state == model.State.ACTIVE).first()
+    if not resource_exists:
+        toolkit.abort(404, _('Dataset resource not found'))
+
+    # Only one pending request per user and resource
+    track_requests = restricted_model.table_exists(
+        restricted_model.access_request_table)
+    user_obj = model.User.get(context['user'])
+    if track_requests:
+        duplicate = restricted_model.has_pending_access_request(
+            data_dict.get('resource_id'), user_obj.id)
+        if not duplicate:
+            # the unique index catches a concurrent double submit
+            try:
+                restricted_model.create_access_request(
+                    data_dict.get('resource_id'), pkg['id'], user_obj.id,
+                    data_dict.get('message', ''))
+            except IntegrityError:
+                model.Session.rollback()
+                duplicate = True
+        if duplicate:
+            return render(
+                'restricted/restricted_request_access_result.html',
+                extra_vars={'data': data_dict, 'pkg_dict': pkg,
+                            'success': False, 'duplicate': True})
+
     success = _send_request_mail(data_dict)
 
+    if track_requests:
+        if success:
+            model.repo.commit()
+        else:
+            model.Session.rollback()
+
     return render(
         'restricted/restricted_request_access_result.html',
         extra_vars={'data': data_dict, 'pkg_dict': pkg, 'success': success})
 
 
+def _get_package_summary(context, package_id):
+    """The package fields used by the request access pages.
+
+    Loads the package row only, instead of running package_show with
+    its extras, resources and the restricted masking.
+    """
+    package = model.Package.get(package_id)
+    if not package or package.state == model.State.DELETED:
+        raise toolkit.ObjectNotFound()
+    logic.check_access(
+        'package_show', dict(context, package=package), {'id': package.id})
+
+    package_license = package.license
+    organization = model.Group.get(package.owner_org) if package.owner_org else None
+    return {
+        'id': package.id,
+        'name': package.name,
+        'title': package.title,
+        'type': package.type,
+        'owner_org': package.owner_org,
+        'organization': {
+            'name': organization.name,
+            'title': organization.title} if organization else None,
+        'license_title': package_license.title if package_license else package.license_id,
+        'license_url': package_license.url if package_license else '#',
+        'maintainer': package.maintainer,
+        'maintainer_email': package.maintainer_email,
+        'author': package.author,
+        'author_email': package.author_email,
+        'metadata_modified': package.metadata_modified.isoformat()
+        if package.metadata_modified else None}
+
+
 def _get_contact_details(pkg_dict):
+    """Contact of the package, cached per package revision."""
+    revision = (pkg_dict.get('id'), pkg_dict.get('metadata_modified'))
+    if not all(revision):
+        return _parse_contact_details(pkg_dict)
+    contact_details = _contact_details_cache.get(revision)
+    if contact_details is None:
+        contact_details = _parse_contact_details(pkg_dict)
+        _contact_details_cache.set(revision, contact_details)
+    return contact_details
+
+
+def _parse_contact_details(pkg_dict):
     contact_email = ""
     contact_name = ""
     # Maintainer as Composite field
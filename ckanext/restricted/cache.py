@@ -0,0 +1,285 @@
+# coding: utf8
+
+from __future__ import unicode_literals
+from ckan.common import g
+from ckan.lib.redis import connect_to_redis
+import ckan.plugins.toolkit as toolkit
+from ckanext.restricted import metrics
+from flask import has_request_context
+import json
+from redis.exceptions import RedisError
+import threading
+import time
+
+from logging import getLogger
+log = getLogger(__name__)
+
+
+_MISSING = object()
+
+
+def request_cache(name):
+    """Return a dict scoped to the current request.
+
+    Outside of a request (CLI commands, background jobs) a fresh dict is
+    returned every time, so nothing is cached there.
+    """
+    if not has_request_context():
+        return {}
+    caches = getattr(g, '_restricted_caches', None)
+    if caches is None:
+        caches = {}
+        g._restricted_caches = caches
+    return caches.setdefault(name, {})
+
+
+def reset_request_caches():
+    """Drop the request caches, for long running streaming responses."""
+    if has_request_context():
+        g._restricted_caches = {}
+
+
+REDIS_PREFIX = 'ckanext-restricted'
+
+
+class TTLCache(object):
+    """Small thread-safe cache shared by all requests of a process.
+
+    Entries expire after `ttl` seconds, a `ttl` of 0 disables the cache.
+    """
+
+    def __init__(self, ttl=0, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        if not self.ttl:
+            return default
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            expires, value = entry
+            if expires < time.time():
+                del self._data[key]
+                return default
+            return value
+
+    def set(self, key, value):
+        if not self.ttl:
+            return
+        with self._lock:
+            if len(self._data) >= self.maxsize:
+                self._data.clear()
+            self._data[key] = (time.time() + self.ttl, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_matching(self, predicate):
+        """Delete the entries whose key matches `predicate`."""
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCache(object):
+    """Counterpart of a TTLCache shared by all processes through Redis.
+
+    Entries are stored as JSON under a key made of the cache generation
+    and the versions the entry depends on, e.g. the user of a decision.
+    Bumping one of them with bump_version makes the old entries
+    unreachable without scanning for them, they expire after the TTL of
+    the `local` cache. The `local` cache is used when Redis fails.
+    """
+
+    def __init__(self, name, local, connection):
+        self.name = name
+        self.local = local
+        self.connection = connection
+
+    def _key(self, key, versions):
+        versions = [('cache', self.name)] + list(versions)
+        numbers = self.connection.mget([_version_key(*v) for v in versions])
+        return '{0}:{1}:{2}:{3}'.format(
+            REDIS_PREFIX, self.name,
+            '.'.join(str(int(number or 0)) for number in numbers),
+            json.dumps(key))
+
+    def get(self, key, default=None, versions=()):
+        if not self.local.ttl:
+            return default
+        try:
+            value = self.connection.get(self._key(key, versions))
+        except RedisError as e:
+            log.warning('Shared cache %s not available: %s', self.name, e)
+            return self.local.get(key, default)
+        if value is None:
+            return default
+        return json.loads(value)
+
+    def set(self, key, value, versions=()):
+        if not self.local.ttl:
+            return
+        try:
+            self.connection.setex(
+                self._key(key, versions), self.local.ttl, json.dumps(value))
+        except RedisError as e:
+            log.warning('Shared cache %s not available: %s', self.name, e)
+            self.local.set(key, value)
+
+
+# user name -> {org_id: org_name}
+organization_cache = TTLCache()
+# package id -> owner_org
+owner_org_cache = TTLCache()
+# (user, resource id, metadata_modified, package id)
+#     -> (resource_show decision, level)
+decision_cache = TTLCache()
+
+# cache name -> RedisCache, empty unless ckanext.restricted.redis_cache
+_shared_caches = {}
+_redis = None
+
+
+def configure(config_):
+    global _redis
+    organization_cache.ttl = int(
+        config_.get('ckanext.restricted.organization_cache_ttl', 0))
+    organization_cache.clear()
+    owner_org_cache.ttl = int(
+        config_.get('ckanext.restricted.owner_org_cache_ttl', 0))
+    owner_org_cache.clear()
+    decision_cache.ttl = int(
+        config_.get('ckanext.restricted.decision_cache_ttl', 0))
+    decision_cache.clear()
+
+    _shared_caches.clear()
+    _redis = None
+    if not toolkit.asbool(config_.get('ckanext.restricted.redis_cache', False)):
+        return
+    try:
+        connection = connect_to_redis()
+        connection.ping()
+    except RedisError as e:
+        log.warning('Redis not available, caching in process only: %s', e)
+        return
+    _redis = connection
+    for name, local in [('organizations', organization_cache),
+                        ('owner_org', owner_org_cache),
+                        ('decisions', decision_cache)]:
+        _shared_caches[name] = RedisCache(name, local, connection)
+
+
+def _version_key(kind, id_):
+    return '{0}:version:{1}:{2}'.format(REDIS_PREFIX, kind, id_)
+
+
+def bump_version(kind, id_):
+    """Invalidate the shared entries depending on the (kind, id_) version."""
+    if _redis is None:
+        return
+    try:
+        _redis.incr(_version_key(kind, id_))
+    except RedisError as e:
+        log.warning('Could not invalidate %s %s in Redis: %s', kind, id_, e)
+
+
+def _cached(name, ttl_cache, key, loader, versions=()):
+    values = request_cache(name)
+    value = values.get(key, _MISSING)
+    metrics.cache_lookup(name, value is not _MISSING)
+    if value is _MISSING:
+        shared = _shared_caches.get(name)
+        if shared is not None:
+            value = shared.get(key, _MISSING, versions)
+        else:
+            value = ttl_cache.get(key, _MISSING)
+        metrics.cache_lookup(name + '_ttl', value is not _MISSING)
+        if value is _MISSING:
+            value = loader(key)
+            if shared is not None:
+                shared.set(key, value, versions)
+            else:
+                ttl_cache.set(key, value)
+        values[key] = value
+    return value
+
+
+def get_user_organizations(user, loader):
+    """Return the {org_id: org_name} dict of the user.
+
+    The result is cached for the current request and, if
+    `ckanext.restricted.organization_cache_ttl` is set, across requests.
+    `loader` is called with the user name on a cache miss.
+    """
+    return _cached('organizations', organization_cache, user, loader,
+                   [('user', user)])
+
+
+def invalidate_user_organizations(*users):
+    organizations = request_cache('organizations')
+    for user in users:
+        if user:
+            organizations.pop(user, None)
+            organization_cache.delete(user)
+            bump_version('user', user)
+
+
+def get_package_owner_org(package_id, loader):
+    """Return the owner_org of a package, cached like the organizations
+    of a user (`ckanext.restricted.owner_org_cache_ttl`).
+    """
+    return _cached('owner_org', owner_org_cache, package_id, loader,
+                   [('package', package_id)])
+
+
+def invalidate_package_owner_org(package_id):
+    request_cache('owner_org').pop(package_id, None)
+    owner_org_cache.delete(package_id)
+    bump_version('package', package_id)
+
+
+def get_resource_decision(key, loader):
+    """Return the (resource_show decision, level) for
+    (user, resource_id, resource metadata_modified, package_id), cached
+    for the request and `ckanext.restricted.decision_cache_ttl` seconds.
+    """
+    user, resource_id, _, package_id = key
+    return _cached('decisions', decision_cache, key, loader,
+                   [('user', user), ('resource', resource_id),
+                    ('package', package_id)])
+
+
+def _invalidate_decisions_matching(predicate):
+    decisions = request_cache('decisions')
+    for key in [key for key in decisions if predicate(key)]:
+        del decisions[key]
+    decision_cache.delete_matching(predicate)
+
+
+def invalidate_resource_decisions(resource_id):
+    _invalidate_decisions_matching(lambda key: key[1] == resource_id)
+    bump_version('resource', resource_id)
+
+
+def invalidate_package_decisions(package_id):
+    """Drop the cached decisions of the resources of a package, e.g.
+    after its owner organization or visibility changed.
+    """
+    _invalidate_decisions_matching(lambda key: key[3] == package_id)
+    bump_version('package', package_id)
+
+
+def invalidate_decisions():
+    """Drop all cached decisions, e.g. after a membership changed."""
+    request_cache('decisions').clear()
+    decision_cache.clear()
+    bump_version('cache', 'decisions')
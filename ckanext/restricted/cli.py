@@ -0,0 +1,54 @@
+# coding: utf8
+
+from __future__ import unicode_literals
+import ckan.model as model
+from ckanext.restricted import action
+from ckanext.restricted import logic
+from ckanext.restricted import model as restricted_model
+import click
+import json
+from sqlalchemy import text
+
+from logging import getLogger
+log = getLogger(__name__)
+
+
+def get_commands():
+    return [restricted]
+
+
+@click.group()
+def restricted():
+    """ckanext-restricted management commands."""
+    pass
+
+
+@restricted.command('init-db')
+def init_db():
+    """Create the database indexes and tables used by the extension."""
+    # allowed users given as emails are matched with lower(email)
+    model.Session.execute(text(
+        'CREATE INDEX IF NOT EXISTS idx_restricted_user_lower_email '
+        'ON "user" (lower(email))'))
+    model.Session.commit()
+    restricted_model.init_tables()
+    click.secho('ckanext-restricted database initialized', fg='green')
+
+
+@restricted.command('rebuild-access-index')
+def rebuild_access_index():
+    """Rebuild the resource access index from scratch."""
+    restricted_model.init_tables()
+    count = restricted_model.rebuild_index(logic.restricted_get_restricted_policy)
+    click.secho('Indexed {} resources'.format(count), fg='green')
+
+
+@restricted.command('export-packages')
+@click.option('--user', default='', help='Export the datasets visible to '
+              'this user, the public ones if not given.')
+@click.option('--output', type=click.File('w'), default='-',
+              help='JSON lines file, stdout by default.')
+def export_packages(user, output):
+    """Export the datasets visible to a user as JSON lines."""
+    for package_dict in action.restricted_iter_package_export(model, user):
+        output.write(json.dumps(package_dict) + '\n')
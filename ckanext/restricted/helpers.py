@@ -2,7 +2,34 @@
 
 
 from ckan.common import c
+import ckan.model as model
+from ckanext.restricted import cache
+from ckanext.restricted import logic
 
 
 def restricted_get_user_id():
     return (str(c.user))
+
+
+def restricted_get_resources_authorization(pkg_dict):
+    """Authorize all the resources of a dataset at once for templates.
+
+    Returns {'can_edit': bool, 'resources': {resource_id: bool}}, cached
+    for the rest of the request, so each resource snippet only does a
+    dict lookup instead of running check_access.
+    """
+    authorizations = cache.request_cache('resources_authorization')
+    package_id = pkg_dict.get('id')
+    authorization = authorizations.get(package_id)
+    if authorization is None:
+        context = {'model': model, 'user': c.user}
+        can_edit = logic.restricted_user_can_edit_package(context, package_id)
+        user_name = logic.restricted_get_username_from_context(context)
+        resources = {}
+        for resource in pkg_dict.get('resources', []):
+            resources[resource.get('id')] = can_edit or \
+                logic.restricted_check_user_resource_access(
+                    user_name, resource, pkg_dict).get('success', False)
+        authorization = {'can_edit': can_edit, 'resources': resources}
+        authorizations[package_id] = authorization
+    return authorization
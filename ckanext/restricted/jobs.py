@@ -0,0 +1,158 @@
+# coding: utf8
+
+from __future__ import unicode_literals
+from ckan.common import config
+import ckan.lib.mailer as mailer
+import ckan.plugins.toolkit as toolkit
+from ckanext.restricted import metrics
+from email.header import Header
+from email.mime.text import MIMEText
+from email.utils import formataddr, formatdate
+import smtplib
+import time
+
+from logging import getLogger
+log = getLogger(__name__)
+
+
+def mail_message(recipient_name, recipient_email, subject, body, headers=None):
+    return {
+        'recipient_name': recipient_name,
+        'recipient_email': recipient_email,
+        'subject': subject,
+        'body': body,
+        'headers': headers or {}}
+
+
+def enqueue_mails(messages):
+    """Send a batch of mail messages (see mail_message) in the background.
+
+    The batch is queued as one background job, unless
+    `ckanext.restricted.async_mail` is false or the job queue is not
+    available, then it is sent right away. Raises MailerException if a
+    synchronous delivery fails.
+    """
+    messages = [message for message in messages
+                if message.get('recipient_email')]
+    if not messages:
+        return
+
+    if toolkit.asbool(config.get('ckanext.restricted.async_mail', True)):
+        try:
+            toolkit.enqueue_job(
+                send_mails, [messages],
+                title='restricted: send {} mail(s)'.format(len(messages)))
+            return
+        except Exception as e:
+            log.warning(('enqueue_mails: Cannot queue mails, '
+                         'sending them now: {}').format(e))
+
+    failed = send_mails(messages, retries=0)
+    if failed:
+        raise mailer.MailerException(
+            'Failed to send {} mail(s)'.format(len(failed)))
+
+
+@metrics.timed('send_mails')
+def send_mails(messages, retries=None):
+    """Background job sending messages through one SMTP connection.
+
+    Failed messages are retried `ckanext.restricted.mail_retries` times
+    with an exponential backoff. Returns the messages that could not be
+    sent.
+    """
+    if retries is None:
+        retries = int(config.get('ckanext.restricted.mail_retries', 3))
+    backoff = float(config.get('ckanext.restricted.mail_retry_backoff', 2))
+
+    failed = _send_batch(messages)
+    attempt = 0
+    while failed and attempt < retries:
+        delay = backoff * (2 ** attempt)
+        attempt += 1
+        log.warning(('send_mails: {0} mail(s) failed, retry {1}/{2} '
+                     'in {3}s').format(len(failed), attempt, retries, delay))
+        time.sleep(delay)
+        failed = _send_batch(failed)
+
+    for message in failed:
+        log.error('send_mails: Failed to send mail to "{}"'.format(
+            message.get('recipient_email')))
+    return failed
+
+
+def _smtp_connect():
+    if config.get('smtp.test_server'):
+        # Use the test SMTP server, like ckan.lib.mailer does
+        smtp_server = config['smtp.test_server']
+        smtp_starttls = False
+        smtp_user = None
+        smtp_password = None
+    else:
+        smtp_server = config.get('smtp.server', 'localhost')
+        smtp_starttls = toolkit.asbool(config.get('smtp.starttls'))
+        smtp_user = config.get('smtp.user')
+        smtp_password = config.get('smtp.password')
+
+    connection = smtplib.SMTP(smtp_server)
+    connection.ehlo()
+    if smtp_starttls:
+        if not connection.has_extn('STARTTLS'):
+            raise mailer.MailerException(
+                'SMTP server does not support STARTTLS')
+        connection.starttls()
+        connection.ehlo()
+    if smtp_user:
+        connection.login(smtp_user, smtp_password)
+    return connection
+
+
+def _build_message(mail_from, message):
+    msg = MIMEText(message['body'], 'plain', 'utf-8')
+    msg['Subject'] = Header(message['subject'], 'utf-8')
+    msg['From'] = formataddr((config.get('ckan.site_title', ''), mail_from))
+    msg['To'] = formataddr(
+        (message.get('recipient_name') or '', message['recipient_email']))
+    msg['Date'] = formatdate(time.time())
+    msg['X-Mailer'] = 'CKAN'
+    reply_to = config.get('smtp.reply_to')
+    if reply_to:
+        msg['Reply-to'] = reply_to
+    for key, value in message.get('headers', {}).items():
+        if key in msg:
+            msg.replace_header(key, value)
+        else:
+            msg[key] = value
+    return msg
+
+
+def _send_batch(messages):
+    mail_from = config.get('smtp.mail_from')
+    failed = []
+    try:
+        connection = _smtp_connect()
+    except (smtplib.SMTPException, mailer.MailerException, OSError) as e:
+        log.warning('send_mails: Cannot connect to SMTP server: {}'.format(e))
+        return list(messages)
+
+    try:
+        for index, message in enumerate(messages):
+            try:
+                connection.sendmail(
+                    mail_from, [message['recipient_email']],
+                    _build_message(mail_from, message).as_string())
+            except (smtplib.SMTPServerDisconnected, OSError) as e:
+                # the connection is lost, the rest is sent on the retry
+                log.warning('send_mails: Disconnected: {}'.format(e))
+                failed.extend(messages[index:])
+                break
+            except smtplib.SMTPException as e:
+                log.warning('send_mails: Failed to send mail to "{0}": {1}'.format(
+                    message['recipient_email'], e))
+                failed.append(message)
+    finally:
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+    return failed
@@ -4,71 +4,183 @@ from __future__ import unicode_literals
 import ckan.authz as authz
 from ckan.common import _
 
-import ckan.lib.mailer as mailer
 import ckan.logic as logic
 import ckan.plugins.toolkit as toolkit
+from ckanext.restricted import cache
+from ckanext.restricted import jobs
+from ckanext.restricted import mails
+from ckanext.restricted import metrics
+from ckanext.restricted import model as restricted_model
+import hashlib
+import hmac
 import json
 
 from ckan.common import config
-import ckan.lib.base as base
+import ckan.model as model
+from enum import Enum
+from flask import has_request_context
+from functools import lru_cache
 
 from logging import getLogger
 
 log = getLogger(__name__)
 
-render = base.render
 
 def restricted_get_username_from_context(context):
+    """Return the name of the user of the context, '' if anonymous.
+
+    The name is resolved once and kept in the context, and for the
+    `user` of contexts without `auth_user_obj` once per request.
+    """
+    user_name = context.get('__restricted_user_name')
+    if user_name is not None:
+        return user_name
+
     auth_user_obj = context.get('auth_user_obj', None)
-    user_name = ''
     if auth_user_obj:
-        user_name = auth_user_obj.as_dict().get('name', '')
+        user_name = auth_user_obj.name or ''
     else:
-        if authz.get_user_id_for_username(context.get('user'), allow_none=True):
-            user_name = context.get('user', '')
+        user = context.get('user') or ''
+        user_names = cache.request_cache('user_names')
+        user_name = user_names.get(user)
+        if user_name is None:
+            user_name = ''
+            if user and authz.get_user_id_for_username(user, allow_none=True):
+                user_name = user
+            user_names[user] = user_name
+
+    context['__restricted_user_name'] = user_name
     return user_name
 
 
-def restricted_get_restricted_dict(resource_dict):
-    restricted_dict = {'level': 'public', 'allowed_users': []}
+class RestrictedLevel(Enum):
+    PUBLIC = 'public'
+    REGISTERED = 'registered'
+    ANY_ORGANIZATION = 'any_organization'
+    SAME_ORGANIZATION = 'same_organization'
+    ONLY_ALLOWED_USERS = 'only_allowed_users'
+
+
+class RestrictedPolicy(object):
+    """Immutable, parsed version of the resource restricted field.
+
+    `level` is a RestrictedLevel or None if the level is not known,
+    `level_name` keeps the raw value. `users` keeps the allowed users in
+    their original order, `allowed_users` is the same as a frozenset.
+    """
+    __slots__ = ('level', 'level_name', 'users', 'allowed_users')
+
+    def __init__(self, level_name, users):
+        if not level_name:
+            level = RestrictedLevel.PUBLIC
+        else:
+            try:
+                level = RestrictedLevel(level_name)
+            except ValueError:
+                level = None
+        object.__setattr__(self, 'level', level)
+        object.__setattr__(self, 'level_name', level_name)
+        object.__setattr__(self, 'users', tuple(users))
+        object.__setattr__(self, 'allowed_users', frozenset(users))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('RestrictedPolicy is immutable')
+
+    def __eq__(self, other):
+        if not isinstance(other, RestrictedPolicy):
+            return NotImplemented
+        return (self.level_name, self.users) == (other.level_name, other.users)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return hash((self.level_name, self.users))
+
+    def as_dict(self):
+        return {'level': self.level_name, 'allowed_users': list(self.users)}
+
+
+PUBLIC_POLICY = RestrictedPolicy('public', [])
+
+
+@lru_cache(maxsize=4096)
+def _restricted_compile_policy(restricted_level, allowed_users):
+    if not isinstance(allowed_users, tuple):
+        allowed_users = allowed_users.split(',')
+    return RestrictedPolicy(restricted_level, allowed_users)
 
+
+@lru_cache(maxsize=4096)
+def _restricted_parse_policy(restricted):
+    # if the restricted property does exist, but not as a dict,
+    # we may need to parse it as a JSON string to gain access to the values.
+    # as is the case when making composite fields
+    try:
+        restricted = json.loads(restricted)
+    except ValueError:
+        restricted = {}
+    if not isinstance(restricted, dict):
+        restricted = {}
+    return _restricted_policy_from_dict(restricted)
+
+
+def _restricted_policy_from_dict(restricted):
+    if not restricted:
+        return PUBLIC_POLICY
+    restricted_level = restricted.get('level', 'public')
+    if restricted_level is not None and not isinstance(restricted_level, str):
+        # malformed level: public if empty like before, unknown otherwise
+        restricted_level = str(restricted_level) if restricted_level else None
+    allowed_users = restricted.get('allowed_users', '')
+    if isinstance(allowed_users, list):
+        allowed_users = tuple(
+            user for user in allowed_users if isinstance(user, str))
+    elif not allowed_users or not isinstance(allowed_users, str):
+        allowed_users = ''
+    return _restricted_compile_policy(restricted_level, allowed_users)
+
+
+def restricted_get_restricted_policy(resource_dict):
+    """Return the RestrictedPolicy of a resource dict.
+
+    Policies are memoized by their raw value, so checking the same
+    restricted field again is a dict lookup instead of a JSON parse.
+    """
     # the ckan plugins ckanext-scheming and ckanext-composite
     # change the structure of the resource dict and the nature of how
     # to access our restricted field values
-    if resource_dict:
-        # the dict might exist as a child inside the extras dict
-        extras = resource_dict.get('extras', {})
-        # or the dict might exist as a direct descendant of the resource dict
-        restricted = resource_dict.get('restricted', extras.get('restricted', {}))
-        if not isinstance(restricted, dict):
-            # if the restricted property does exist, but not as a dict,
-            # we may need to parse it as a JSON string to gain access to the values.
-            # as is the case when making composite fields
-            try:
-                restricted = json.loads(restricted)
-            except ValueError:
-                restricted = {}
+    if not resource_dict:
+        return PUBLIC_POLICY
+
+    # the dict might exist as a child inside the extras dict
+    extras = resource_dict.get('extras', {})
+    # or the dict might exist as a direct descendant of the resource dict
+    restricted = resource_dict.get('restricted', extras.get('restricted', {}))
+    if isinstance(restricted, dict):
+        return _restricted_policy_from_dict(restricted)
+    if isinstance(restricted, str):
+        return _restricted_parse_policy(restricted)
+    return PUBLIC_POLICY
 
-        if restricted:
-            restricted_level = restricted.get('level', 'public')
-            allowed_users = restricted.get('allowed_users', '')
-            if not isinstance(allowed_users, list):
-                allowed_users = allowed_users.split(',')
-            restricted_dict = {
-                'level': restricted_level,
-                'allowed_users': allowed_users}
 
-    return restricted_dict
+metrics.register_lru_cache('policy_parse', _restricted_parse_policy)
+metrics.register_lru_cache('policy_compile', _restricted_compile_policy)
 
 
+def restricted_get_restricted_dict(resource_dict):
+    return restricted_get_restricted_policy(resource_dict).as_dict()
+
+
+@metrics.timed('restricted_check_user_resource_access')
 def restricted_check_user_resource_access(user, resource_dict, package_dict):
-    restricted_dict = restricted_get_restricted_dict(resource_dict)
+    policy = restricted_get_restricted_policy(resource_dict)
 
-    restricted_level = restricted_dict.get('level', 'public')
-    allowed_users = restricted_dict.get('allowed_users', [])
+    restricted_level = policy.level
 
     # Public resources (DEFAULT)
-    if not restricted_level or restricted_level == 'public':
+    if restricted_level is RestrictedLevel.PUBLIC:
         return {'success': True}
 
     # Registered user
@@ -77,28 +189,20 @@ def restricted_check_user_resource_access(user, resource_dict, package_dict):
             'success': False,
             'msg': 'Resource access restricted to registered users'}
     else:
-        if restricted_level == 'registered' or not restricted_level:
+        if restricted_level is RestrictedLevel.REGISTERED:
             return {'success': True}
 
     # Since we have a user, check if it is in the allowed list
-    if user in allowed_users:
+    if user in policy.allowed_users:
         return {'success': True}
-    elif restricted_level == 'only_allowed_users':
+    elif restricted_level is RestrictedLevel.ONLY_ALLOWED_USERS:
         return {
             'success': False,
             'msg': 'Resource access restricted to allowed users only'}
 
     # Get organization list
-    user_organization_dict = {}
-
-    context = {'user': user}
-    data_dict = {'permission': 'read'}
-
-    for org in logic.get_action('organization_list_for_user')(context, data_dict):
-        name = org.get('name', '')
-        id = org.get('id', '')
-        if name and id:
-            user_organization_dict[id] = name
+    user_organization_dict = cache.get_user_organizations(
+        user, restricted_get_user_organizations)
 
     # Any Organization Members (Trusted Users)
     if not user_organization_dict:
@@ -106,13 +210,13 @@ def restricted_check_user_resource_access(user, resource_dict, package_dict):
             'success': False,
             'msg': 'Resource access restricted to members of an organization'}
 
-    if restricted_level == 'any_organization':
+    if restricted_level is RestrictedLevel.ANY_ORGANIZATION:
         return {'success': True}
 
     pkg_organization_id = package_dict.get('owner_org', '')
 
     # Same Organization Members
-    if restricted_level == 'same_organization':
+    if restricted_level is RestrictedLevel.SAME_ORGANIZATION:
         if pkg_organization_id in user_organization_dict.keys():
             return {'success': True}
 
@@ -122,9 +226,164 @@ def restricted_check_user_resource_access(user, resource_dict, package_dict):
                 'organization ({}) members').format(pkg_organization_id)}
 
 
-def restricted_mail_allowed_user(user_id, resource):
-    if not user_id:
+def restricted_index_package(package_id_or_name):
+    if not package_id_or_name or not restricted_model.tables_exist():
         return
+    package = model.Package.get(package_id_or_name)
+    if package:
+        restricted_model.index_package(
+            package.id, restricted_get_restricted_policy)
+
+
+def restricted_user_can_edit_package(context, package_id):
+    """Check package_update for the context user, once per request.
+
+    All the resources of a package share the decision, which is cached
+    by (user, package_id) for the rest of the request.
+    """
+    if context.get('ignore_auth'):
+        return True
+
+    decisions = cache.request_cache('package_update')
+    key = (context.get('user'), package_id)
+    can_edit = decisions.get(key)
+    metrics.cache_lookup('package_update', can_edit is not None)
+    if can_edit is None:
+        # auth functions cache the package object in the context,
+        # make sure it is the one of package_id
+        package_context = dict(context)
+        package_context.pop('package', None)
+        can_edit = authz.is_authorized(
+            'package_update', package_context,
+            {'id': package_id}).get('success', False)
+        decisions[key] = can_edit
+    return can_edit
+
+
+def restricted_get_package_owner_org(package_id):
+    """owner_org of a package, without loading the whole package."""
+    return cache.get_package_owner_org(package_id, _restricted_load_owner_org)
+
+
+def _restricted_load_owner_org(package_id):
+    return model.Session.query(model.Package.owner_org).filter(
+        model.Package.id == package_id).scalar()
+
+
+def restricted_get_user_organizations(user):
+    user_organization_dict = {}
+
+    context = {'user': user}
+    data_dict = {'permission': 'read'}
+
+    for org in logic.get_action('organization_list_for_user')(context, data_dict):
+        name = org.get('name', '')
+        id = org.get('id', '')
+        if name and id:
+            user_organization_dict[id] = name
+
+    return user_organization_dict
+
+
+def restricted_index_fields(package_dict):
+    """Return the restricted Solr fields of a validated package dict.
+
+    vocab_* is the multi-valued exact-match dynamic field of the stock
+    CKAN Solr schema, so no schema change is needed. The fields can be
+    read by anyone through package_search, so the allowed users are
+    indexed as tokens (restricted_user_index_token), and not at all
+    without a secret.
+    """
+    restricted_levels = set()
+    restricted_allowed_users = set()
+    for resource in package_dict.get('resources', []):
+        policy = restricted_get_restricted_policy(resource)
+        if policy.level:
+            restricted_levels.add(policy.level.value)
+        else:
+            restricted_levels.add(policy.level_name)
+        if policy.level is not RestrictedLevel.PUBLIC:
+            restricted_allowed_users.update(
+                user.strip() for user in policy.users if user.strip())
+
+    allowed_user_tokens = []
+    if restricted_allowed_users:
+        if _restricted_index_secret():
+            allowed_user_tokens = sorted(
+                restricted_user_index_token(user) for user in restricted_allowed_users)
+        else:
+            log.error(('restricted_index_fields: Allowed users of dataset "{}" '
+                       'not indexed, set ckanext.restricted.index_secret').format(
+                           package_dict.get('id')))
+    return {
+        'vocab_restricted_levels': sorted(restricted_levels),
+        'vocab_restricted_allowed_users': allowed_user_tokens}
+
+
+def _restricted_index_secret():
+    return config.get('ckanext.restricted.index_secret') or \
+        config.get('beaker.session.secret')
+
+
+def restricted_user_index_token(user_name):
+    """Non reversible token of a user name for the search index, None if
+    no secret is configured.
+
+    HMAC of the name with `ckanext.restricted.index_secret`, or
+    `beaker.session.secret` if not set.
+    """
+    secret = _restricted_index_secret()
+    if not secret:
+        return None
+    return hmac.new(secret.encode('utf-8'), user_name.encode('utf-8'),
+                    hashlib.sha256).hexdigest()
+
+
+def restricted_accessible_filter_query(user):
+    """Solr filter matching datasets with at least one resource the user
+    can access, or None if the user can access everything.
+    """
+    if user and authz.is_sysadmin(user):
+        return None
+
+    def _solr_list(values):
+        return ' OR '.join('"{}"'.format(value) for value in values)
+
+    conditions = ['vocab_restricted_levels:public']
+    if user:
+        conditions.append('vocab_restricted_levels:registered')
+        user_token = restricted_user_index_token(user)
+        if user_token:
+            conditions.append(
+                'vocab_restricted_allowed_users:"{}"'.format(user_token))
+
+        user_organization_dict = cache.get_user_organizations(
+            user, restricted_get_user_organizations)
+        if user_organization_dict:
+            conditions.append('vocab_restricted_levels:any_organization')
+            conditions.append(
+                '(vocab_restricted_levels:same_organization AND owner_org:({}))'.format(
+                    _solr_list(user_organization_dict.keys())))
+
+        # editors can see all the resources of their datasets
+        editable_organizations = logic.get_action('organization_list_for_user')(
+            {'user': user}, {'permission': 'update_dataset'})
+        if editable_organizations:
+            conditions.append('owner_org:({})'.format(
+                _solr_list(org['id'] for org in editable_organizations)))
+        user_id = authz.get_user_id_for_username(user, allow_none=True)
+        if user_id:
+            conditions.append('creator_user_id:"{}"'.format(user_id))
+
+    return ' OR '.join(conditions)
+
+
+def restricted_allowed_user_bulk_mails(user_id, resources):
+    """Mails notifying user_id of the access granted to resources, one
+    mail for all of them.
+    """
+    if not user_id or not resources:
+        return []
     log.debug('restricted_mail_allowed_user: Notifying "{}"'.format(user_id))
     try:
         # Get user information
@@ -134,57 +393,131 @@ def restricted_mail_allowed_user(user_id, resource):
         user = toolkit.get_action('user_show')(context, {'id': user_id})
         user_email = user['email']
         user_name = user.get('display_name', user['name'])
-        resource_name = resource.get('name', resource['id'])
 
         # maybe check user[activity_streams_email_notifications]==True
 
-        mail_body = restricted_allowed_user_mail_body(user, resource)
-        mail_subject = _('Access granted to resource {}').format(resource_name)
-
-        # Send mail to user
-        mailer.mail_recipient(user_name, user_email, mail_subject, mail_body)
-
-        # Send copy to admin
-        mailer.mail_recipient(
-            'CKAN Admin', config.get('email_to'),
-            'Fwd: {}'.format(mail_subject), mail_body)
+        if len(resources) == 1:
+            resource_name = resources[0].get('name', resources[0]['id'])
+            mail_body = restricted_allowed_user_mail_body(user, resources[0])
+            mail_subject = _('Access granted to resource {}').format(resource_name)
+        else:
+            mail_body = restricted_allowed_user_bulk_mail_body(user, resources)
+            mail_subject = _('Access granted to {} resources').format(len(resources))
+
+        return [
+            # Send mail to user
+            jobs.mail_message(user_name, user_email, mail_subject, mail_body),
+            # Send copy to admin
+            jobs.mail_message(
+                'CKAN Admin', config.get('email_to'),
+                'Fwd: {}'.format(mail_subject), mail_body)]
 
     except Exception as e:
         log.warning(('restricted_mail_allowed_user: '
-                     'Failed to send mail to "{0}": {1}').format(user_id, e))
+                     'Failed to prepare mail to "{0}": {1}').format(user_id, e))
+        return []
 
 
-def restricted_allowed_user_mail_body(user, resource):
-    resource_link = toolkit.url_for(
-        controller='dataset_resource', action='read',
-        id=resource.get('package_id'), resource_id=resource.get('id'))
+def _restricted_resource_link(resource):
+    return mails.resource_url(resource.get('package_id'), resource.get('id'))
 
+
+def restricted_allowed_user_mail_body(user, resource):
     extra_vars = {
-        'site_title': config.get('ckan.site_title'),
-        'site_url': config.get('ckan.site_url'),
         'user_name': user.get('display_name', user['name']),
         'resource_name': resource.get('name', resource['id']),
-        'resource_link': config.get('ckan.site_url') + resource_link,
+        'resource_link': _restricted_resource_link(resource),
         'resource_url': resource.get('url')}
 
-    return render('restricted/emails/restricted_user_allowed.txt', extra_vars)
+    return mails.render('restricted/emails/restricted_user_allowed.txt', extra_vars)
 
 
-def restricted_notify_allowed_users(previous_value, updated_resource):
+def restricted_allowed_user_bulk_mail_body(user, resources):
+    extra_vars = {
+        'user_name': user.get('display_name', user['name']),
+        'resources': [{
+            'name': resource.get('name', resource['id']),
+            'link': _restricted_resource_link(resource),
+            'url': resource.get('url')} for resource in resources]}
 
-    def _safe_json_loads(json_string, default={}):
-        try:
-            return json.loads(json_string)
-        except Exception:
-            return default
+    return mails.render('restricted/emails/restricted_user_allowed_bulk.txt', extra_vars)
 
-    previous_restricted = _safe_json_loads(previous_value)
-    updated_restricted = _safe_json_loads(updated_resource.get('restricted', ''))
 
-    # compare restricted users_allowed values
-    updated_allowed_users = set(updated_restricted.get('allowed_users', '').split(','))
-    if updated_allowed_users:
-        previous_allowed_users = previous_restricted.get('allowed_users', '').split(',')
-        for user_id in updated_allowed_users:
-            if user_id not in previous_allowed_users:
-                restricted_mail_allowed_user(user_id, updated_resource)
+@metrics.timed('restricted_notify_allowed_users_bulk')
+def restricted_notify_allowed_users_bulk(grants):
+    """Send one notification per user for {user_id: [resource_dict]}."""
+    messages = []
+    for user_id, resources in grants.items():
+        messages += restricted_allowed_user_bulk_mails(user_id, resources)
+    try:
+        jobs.enqueue_mails(messages)
+    except Exception as e:
+        log.warning(('restricted_notify_allowed_users: '
+                     'Failed to send mails: {}').format(e))
+
+
+def _restricted_allowed_user_names(resource):
+    if not resource:
+        return frozenset()
+    policy = restricted_get_restricted_policy(resource)
+    return frozenset(user.strip() for user in policy.users if user.strip())
+
+
+def restricted_allowed_users_added(previous_resource, updated_resource):
+    """Return the users allowed in `updated_resource` but not in
+    `previous_resource` (None for a new resource). Both can be resource
+    dicts or extras dicts, with the restricted field as string or dict.
+    """
+    return _restricted_allowed_user_names(updated_resource) - \
+        _restricted_allowed_user_names(previous_resource)
+
+
+def restricted_collect_grants(grants, previous_resources, updated_resources):
+    """Add the users added to the `updated_resources` to the
+    {user: [resource dict]} `grants`. `previous_resources` maps resource
+    ids to their previous value, new resources are missing from it.
+    """
+    for resource in updated_resources:
+        added_users = restricted_allowed_users_added(
+            previous_resources.get(resource.get('id')), resource)
+        for user in added_users:
+            grants.setdefault(user, []).append(resource)
+    return grants
+
+
+def restricted_queue_notifications(grants):
+    """Notify the {user: [resource dict]} grants once the request is
+    over, with one mail per user for all the changes of the request.
+    Outside of a request the mails are sent right away.
+    """
+    if not grants:
+        return
+    if not has_request_context():
+        restricted_notify_allowed_users_bulk(grants)
+        return
+    pending = cache.request_cache('notifications')
+    for user, resources in grants.items():
+        for resource in resources:
+            pending.setdefault(user, {})[resource['id']] = resource
+
+
+def restricted_dispatch_notifications(exception=None):
+    """Request teardown handler sending the queued notifications."""
+    pending = cache.request_cache('notifications')
+    grants = dict((user, list(resources.values()))
+                  for user, resources in pending.items())
+    pending.clear()
+    # grants are only queued by successful actions, an exception here
+    # means the request failed after them
+    if grants and exception is None:
+        restricted_notify_allowed_users_bulk(grants)
+
+
+def restricted_package_resources(package_id):
+    """Resource dicts of the active resources of a dataset, read from
+    the database objects.
+    """
+    package = model.Package.get(package_id) if package_id else None
+    if not package:
+        return []
+    return [resource.as_dict() for resource in package.resources]
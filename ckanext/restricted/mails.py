@@ -0,0 +1,76 @@
+# coding: utf8
+
+from __future__ import unicode_literals
+from ckan.common import _, config, ungettext
+import ckan.plugins.toolkit as toolkit
+from jinja2 import Environment, FileSystemLoader
+import os
+
+from logging import getLogger
+log = getLogger(__name__)
+
+
+TEMPLATES = [
+    'restricted/emails/restricted_access_request.txt',
+    'restricted/emails/restricted_user_allowed.txt',
+    'restricted/emails/restricted_user_allowed_bulk.txt',
+    'restricted/emails/restricted_user_registered.txt']
+
+_TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+
+# the environment with the compiled templates and the URL patterns,
+# built lazily on first use: the template search path is only computed
+# once all the plugins are loaded
+_state = {}
+
+
+def configure(config_):
+    _state.clear()
+
+
+def _environment():
+    environment = _state.get('environment')
+    if environment is None:
+        # same search path as the CKAN templates, so the mails can still
+        # be overridden by other extensions
+        template_paths = config.get('computed_template_paths') or [_TEMPLATE_DIR]
+        # escaped like the templates rendered by CKAN
+        environment = Environment(
+            loader=FileSystemLoader(template_paths),
+            extensions=['jinja2.ext.i18n'],
+            autoescape=True,
+            auto_reload=False)
+        environment.install_gettext_callables(_, ungettext, newstyle=True)
+        environment.globals.update({
+            'site_title': config.get('ckan.site_title'),
+            'site_url': config.get('ckan.site_url'),
+            'admin_email_to': config.get('email_to', 'email_to_undefined')})
+        for template_name in TEMPLATES:
+            environment.get_template(template_name)
+        _state['environment'] = environment
+    return environment
+
+
+def render(template_name, extra_vars):
+    """Render a mail template. `site_title`, `site_url` and
+    `admin_email_to` are always available.
+    """
+    return _environment().get_template(template_name).render(extra_vars)
+
+
+def resource_url(package_id, resource_id, action='read'):
+    """Absolute URL of a resource page.
+
+    The route is only resolved once per action, the ids are then
+    substituted into it. The links are built without the locale of the
+    current request, the mails are read by other users.
+    """
+    patterns = _state.setdefault('resource_urls', {})
+    pattern = patterns.get(action)
+    if pattern is None:
+        pattern = config.get('ckan.site_url') + toolkit.url_for(
+            controller='dataset_resource', action=action, locale='default',
+            id='__package_id__', resource_id='__resource_id__')
+        patterns[action] = pattern
+    return pattern.replace('__package_id__', package_id or '').replace(
+        '__resource_id__', resource_id or '')
@@ -0,0 +1,283 @@
+# coding: utf8
+
+from __future__ import unicode_literals
+from bisect import bisect_left
+from ckan.lib.redis import connect_to_redis
+from flask import has_request_context
+from functools import wraps
+import json
+from redis.exceptions import RedisError
+import threading
+import time
+
+import ckan.plugins.toolkit as toolkit
+
+from logging import getLogger
+log = getLogger(__name__)
+
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REDIS_PREFIX = 'ckanext-restricted:metrics'
+
+# seconds between two flushes outside of a request (CLI, background jobs)
+FLUSH_INTERVAL = 10
+
+_metrics = []
+
+# nothing is recorded unless ckanext.restricted.metrics_enabled is set
+enabled = False
+# bearer token of the scrapers, sysadmins can always read the metrics
+token = ''
+_redis = None
+_last_flush = 0
+
+
+def configure(config_):
+    global enabled, token, _redis
+    enabled = toolkit.asbool(config_.get('ckanext.restricted.metrics_enabled', False))
+    token = config_.get('ckanext.restricted.metrics_token', '')
+    _redis = connect_to_redis() if enabled else None
+    for metric in _metrics:
+        metric.take()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in labels) + '}'
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric(object):
+    """Values recorded by this process since the last flush, as
+    {field: amount}. The totals of all the processes are kept in a Redis
+    hash per metric, see flush and render.
+    """
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._pending = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _labels(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def _add(self, field, amount):
+        self._pending[field] = self._pending.get(field, 0) + amount
+
+    def take(self):
+        """Return and reset the values recorded since the last flush."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def restore(self, pending):
+        """Put back values that could not be flushed."""
+        with self._lock:
+            for field, amount in pending.items():
+                self._add(field, amount)
+
+    def _header(self, metric_type):
+        return ['# HELP {0} {1}'.format(self.name, self.documentation),
+                '# TYPE {0} {1}'.format(self.name, metric_type)]
+
+
+class Counter(_Metric):
+    """Prometheus counter, values are kept per label set."""
+
+    def inc(self, amount=1, **labels):
+        if not enabled:
+            return
+        key = self._labels(labels)
+        with self._lock:
+            self._add(key, amount)
+
+    def render(self, values):
+        lines = self._header('counter')
+        for key, value in sorted((tuple(field), value) for field, value in values):
+            lines.append('{0}{1} {2}'.format(
+                self.name, _format_labels(list(zip(self.labelnames, key))),
+                _format_value(value)))
+        return lines
+
+
+class Histogram(_Metric):
+    """Prometheus histogram, observations are kept per label set."""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        if not enabled:
+            return
+        key = self._labels(labels)
+        # only the first matching bucket is counted, render() sums them up
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self._add((key, index), 1)
+            self._add((key, 'sum'), value)
+
+    def render(self, values):
+        lines = self._header('histogram')
+        # label values -> [bucket counts, sum]
+        series = {}
+        for (key, index), value in values:
+            entry = series.setdefault(
+                tuple(key), [[0] * (len(self.buckets) + 1), 0.0])
+            if index == 'sum':
+                entry[1] = value
+            else:
+                entry[0][index] = value
+        for key, (counts, total) in sorted(series.items()):
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append('{0}_bucket{1} {2}'.format(
+                    self.name, _format_labels(labels + [('le', bound)]),
+                    _format_value(cumulative)))
+            count = sum(counts)
+            lines.append('{0}_bucket{1} {2}'.format(
+                self.name, _format_labels(labels + [('le', '+Inf')]),
+                _format_value(count)))
+            lines.append('{0}_sum{1} {2}'.format(
+                self.name, _format_labels(labels), _format_value(total)))
+            lines.append('{0}_count{1} {2}'.format(
+                self.name, _format_labels(labels), _format_value(count)))
+        return lines
+
+
+class LRUCacheCollector(Counter):
+    """Exposes the statistics of functools.lru_cache functions."""
+
+    def __init__(self, name, documentation, functions):
+        super(LRUCacheCollector, self).__init__(
+            name, documentation, ['cache', 'result'])
+        self.functions = functions
+        # statistics of this process up to the last flush
+        self._flushed = {}
+
+    def take(self):
+        with self._lock:
+            pending = {}
+            for cache_name, function in self.functions.items():
+                info = function.cache_info()
+                for result, value in [('hit', info.hits), ('miss', info.misses)]:
+                    key = (cache_name, result)
+                    if value != self._flushed.get(key, 0):
+                        pending[key] = value - self._flushed.get(key, 0)
+                        self._flushed[key] = value
+        return pending
+
+    def restore(self, pending):
+        with self._lock:
+            for key, amount in pending.items():
+                self._flushed[key] -= amount
+
+
+decisions = Counter(
+    'restricted_resource_decisions_total',
+    'Resource access decisions of the restricted extension.',
+    ['level', 'outcome'])
+
+durations = Histogram(
+    'restricted_function_duration_seconds',
+    'Duration of the restricted extension functions.',
+    ['function'])
+
+cache_requests = Counter(
+    'restricted_cache_requests_total',
+    'Cache lookups of the restricted extension.',
+    ['cache', 'result'])
+
+lru_cache_requests = LRUCacheCollector(
+    'restricted_lru_cache_requests_total',
+    'Lookups of the memoized functions of the restricted extension.',
+    {})
+
+
+def timed(function_name):
+    """Decorator observing the duration of the function in `durations`."""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                durations.observe(time.time() - start, function=function_name)
+                # requests are flushed when they end
+                if not has_request_context() and \
+                        time.time() - _last_flush >= FLUSH_INTERVAL:
+                    flush()
+        return wrapper
+    return decorator
+
+
+def register_lru_cache(cache_name, function):
+    lru_cache_requests.functions[cache_name] = function
+
+
+def cache_lookup(cache_name, hit):
+    if not enabled:
+        return
+    cache_requests.inc(cache=cache_name, result='hit' if hit else 'miss')
+
+
+def _redis_key(metric):
+    return '{0}:{1}'.format(REDIS_PREFIX, metric.name)
+
+
+def flush(exception=None):
+    """Add the values recorded by this process to the totals in Redis.
+
+    Called when a request ends, the values are kept for the next flush
+    if Redis is not available.
+    """
+    global _last_flush
+    if not enabled or _redis is None:
+        return
+    _last_flush = time.time()
+    pending = [(metric, metric.take()) for metric in _metrics]
+    pending = [(metric, values) for metric, values in pending if values]
+    if not pending:
+        return
+    try:
+        pipeline = _redis.pipeline()
+        for metric, values in pending:
+            for field, amount in values.items():
+                pipeline.hincrbyfloat(
+                    _redis_key(metric), json.dumps(field), amount)
+        pipeline.execute()
+    except RedisError as e:
+        log.warning('Could not flush the metrics to Redis: %s', e)
+        for metric, values in pending:
+            metric.restore(values)
+
+
+def render():
+    """The totals of all the processes in the Prometheus text format.
+    Raises RedisError if Redis is not available.
+    """
+    flush()
+    pipeline = _redis.pipeline()
+    for metric in _metrics:
+        pipeline.hgetall(_redis_key(metric))
+    lines = []
+    for metric, values in zip(_metrics, pipeline.execute()):
+        lines.extend(metric.render(
+            [(json.loads(field), float(value)) for field, value in values.items()]))
+    return '\n'.join(lines) + '\n'
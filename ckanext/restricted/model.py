@@ -0,0 +1,331 @@
+# coding: utf8
+
+from __future__ import unicode_literals
+import ckan.model as model
+from ckan.model import meta
+from ckan.model import types as _types
+import datetime
+import time
+from sqlalchemy import Column, Index, Table, types
+from sqlalchemy import and_, exists, or_, select
+import sqlalchemy
+
+from logging import getLogger
+log = getLogger(__name__)
+
+
+# One row per active resource with its restriction level
+resource_policy_table = Table(
+    'restricted_resource_policy', meta.metadata,
+    Column('resource_id', types.UnicodeText, primary_key=True),
+    Column('package_id', types.UnicodeText, nullable=False, index=True),
+    Column('level', types.UnicodeText, nullable=False, index=True),
+)
+
+# One row per (resource, allowed user)
+allowed_user_table = Table(
+    'restricted_allowed_user', meta.metadata,
+    Column('resource_id', types.UnicodeText, primary_key=True),
+    Column('user_name', types.UnicodeText, primary_key=True),
+    # lists the resources of a user in resource_id order
+    Index('idx_restricted_allowed_user_user_name', 'user_name', 'resource_id'),
+)
+
+# Access requests sent with the request access form
+access_request_table = Table(
+    'restricted_access_request', meta.metadata,
+    Column('id', types.UnicodeText, primary_key=True, default=_types.make_uuid),
+    Column('resource_id', types.UnicodeText, nullable=False, index=True),
+    Column('package_id', types.UnicodeText, nullable=False, index=True),
+    Column('user_id', types.UnicodeText, nullable=False, index=True),
+    Column('message', types.UnicodeText),
+    Column('status', types.UnicodeText, nullable=False, index=True,
+           default='pending'),
+    Column('created', types.DateTime, default=datetime.datetime.utcnow),
+    Column('modified', types.DateTime, default=datetime.datetime.utcnow),
+    # one pending request per user and resource, also on a double submit
+    Index('idx_restricted_access_request_pending',
+          'resource_id', 'user_id', unique=True,
+          postgresql_where=sqlalchemy.text("status = 'pending'")),
+)
+
+ACCESS_REQUEST_STATUSES = ['pending', 'approved', 'rejected']
+
+# table name -> True once it exists, or the time it was found missing
+_existing_tables = {}
+# seconds before a missing table is looked up again
+MISSING_TABLE_RECHECK = 60
+
+
+def init_tables():
+    for table in [resource_policy_table, allowed_user_table, access_request_table]:
+        table.create(meta.engine, checkfirst=True)
+        _existing_tables[table.name] = True
+
+
+def table_exists(table):
+    """True if `ckan restricted init-db` created the table.
+
+    An existing table is cached for good, a missing one is looked up
+    again after MISSING_TABLE_RECHECK seconds, so running processes see
+    the tables created by init-db.
+    """
+    existing = _existing_tables.get(table.name)
+    if existing is True:
+        return True
+    if existing is not None and \
+            time.time() - existing < MISSING_TABLE_RECHECK:
+        return False
+    with meta.engine.connect() as connection:
+        exists = meta.engine.dialect.has_table(connection, table.name)
+    _existing_tables[table.name] = True if exists else time.time()
+    return exists
+
+
+def tables_exist():
+    return table_exists(resource_policy_table) and \
+        table_exists(allowed_user_table)
+
+
+def _policy_rows(resource_id, package_id, policy):
+    level = policy.level.value if policy.level else policy.level_name
+    policy_row = {
+        'resource_id': resource_id, 'package_id': package_id,
+        'level': level or 'public'}
+    user_rows = [
+        {'resource_id': resource_id, 'user_name': user_name}
+        for user_name in set(user.strip() for user in policy.users)
+        if user_name]
+    return policy_row, user_rows
+
+
+def _insert_rows(policy_rows, user_rows):
+    if policy_rows:
+        meta.Session.execute(resource_policy_table.insert(), policy_rows)
+    if user_rows:
+        meta.Session.execute(allowed_user_table.insert(), user_rows)
+
+
+def _active_resources_query():
+    return meta.Session.query(
+        model.Resource.id, model.Resource.package_id, model.Resource.extras
+    ).join(
+        model.Package, model.Package.id == model.Resource.package_id
+    ).filter(
+        model.Resource.state == model.State.ACTIVE,
+        model.Package.state == model.State.ACTIVE)
+
+
+def index_package(package_id, get_policy):
+    """Rewrite the rows of the resources of a package from the database.
+
+    `get_policy` returns the RestrictedPolicy of a resource dict. The
+    changes are part of the current transaction.
+    """
+    if not tables_exist():
+        return
+    resource_ids = select([resource_policy_table.c.resource_id]).where(
+        resource_policy_table.c.package_id == package_id)
+    meta.Session.execute(allowed_user_table.delete().where(
+        allowed_user_table.c.resource_id.in_(resource_ids)))
+    meta.Session.execute(resource_policy_table.delete().where(
+        resource_policy_table.c.package_id == package_id))
+
+    policy_rows = []
+    user_rows = []
+    query = _active_resources_query().filter(
+        model.Resource.package_id == package_id)
+    for resource_id, resource_package_id, extras in query:
+        policy_row, resource_user_rows = _policy_rows(
+            resource_id, resource_package_id, get_policy(extras or {}))
+        policy_rows.append(policy_row)
+        user_rows.extend(resource_user_rows)
+    _insert_rows(policy_rows, user_rows)
+
+
+def rebuild_index(get_policy, batch_size=1000):
+    """Rebuild both tables for all active resources. Returns the count."""
+    meta.Session.execute(allowed_user_table.delete())
+    meta.Session.execute(resource_policy_table.delete())
+
+    count = 0
+    policy_rows = []
+    user_rows = []
+    for resource_id, package_id, extras in \
+            _active_resources_query().yield_per(batch_size):
+        policy_row, resource_user_rows = _policy_rows(
+            resource_id, package_id, get_policy(extras or {}))
+        policy_rows.append(policy_row)
+        user_rows.extend(resource_user_rows)
+        count += 1
+        if len(policy_rows) >= batch_size:
+            _insert_rows(policy_rows, user_rows)
+            policy_rows = []
+            user_rows = []
+    _insert_rows(policy_rows, user_rows)
+    meta.Session.commit()
+    return count
+
+
+def get_resource_with_package(resource_id, package_id_or_name):
+    """Return the active (Resource, Package) objects, or None if the
+    resource does not belong to the active dataset.
+    """
+    return meta.Session.query(model.Resource, model.Package).join(
+        model.Package, model.Package.id == model.Resource.package_id
+    ).filter(
+        model.Resource.id == resource_id,
+        model.Resource.state == model.State.ACTIVE,
+        model.Package.state == model.State.ACTIVE,
+        or_(model.Package.id == package_id_or_name,
+            model.Package.name == package_id_or_name)
+    ).first()
+
+
+def accessible_resources_query(user_obj, restricted_only=True):
+    """Query the ids of the resources `user_obj` (None if anonymous) can
+    access, following the rules of restricted_check_user_resource_access
+    and only in the datasets the user can read.
+    """
+    policy = resource_policy_table.c
+    package = model.package_table.c
+    conditions = []
+    if not restricted_only:
+        conditions.append(policy.level == 'public')
+
+    visible = package.private == False  # noqa: E712
+    if user_obj:
+        conditions.append(policy.level == 'registered')
+        conditions.append(exists().where(and_(
+            allowed_user_table.c.resource_id == policy.resource_id,
+            allowed_user_table.c.user_name == user_obj.name)))
+
+        member = model.member_table.c
+        is_member = and_(
+            member.table_name == 'user',
+            member.table_id == user_obj.id,
+            member.state == model.State.ACTIVE,
+            model.group_table.c.id == member.group_id,
+            model.group_table.c.is_organization == True,  # noqa: E712
+            model.group_table.c.state == model.State.ACTIVE)
+        organization_ids = select([member.group_id]).where(is_member)
+        conditions.append(and_(
+            policy.level == 'any_organization', exists().where(is_member)))
+        conditions.append(and_(
+            policy.level == 'same_organization',
+            package.owner_org.in_(organization_ids)))
+        # private datasets are only readable by the members of their organization
+        visible = or_(visible, package.owner_org.in_(organization_ids))
+
+    query = meta.Session.query(policy.resource_id).select_from(
+        resource_policy_table.join(
+            model.package_table,
+            package.id == policy.package_id)
+    ).filter(package.state == model.State.ACTIVE)
+
+    if user_obj and user_obj.sysadmin:
+        if restricted_only:
+            query = query.filter(policy.level != 'public')
+        return query.order_by(policy.resource_id)
+    if not conditions:
+        return query.filter(sqlalchemy.false())
+    return query.filter(visible, or_(*conditions)).order_by(policy.resource_id)
+
+
+def allowed_user_resources_query(user_name):
+    """Query the resources listing `user_name` in their allowed users,
+    as (resource_id, package_id, level, resource name) ordered by
+    resource id.
+    """
+    allowed_user = allowed_user_table.c
+    policy = resource_policy_table.c
+    return meta.Session.query(
+        allowed_user.resource_id, policy.package_id, policy.level,
+        model.resource_table.c.name
+    ).select_from(allowed_user_table.join(
+        resource_policy_table, policy.resource_id == allowed_user.resource_id
+    ).join(
+        model.resource_table, model.resource_table.c.id == allowed_user.resource_id
+    ).join(
+        model.package_table, model.package_table.c.id == policy.package_id
+    )).filter(
+        allowed_user.user_name == user_name,
+        model.package_table.c.state == model.State.ACTIVE
+    ).order_by(allowed_user.resource_id)
+
+
+def visible_packages_query(user_obj, organization_ids, after=None):
+    """Query the ids of the active datasets `user_obj` (None if
+    anonymous) can read, public ones and the private ones of the
+    `organization_ids`, ordered by id and starting after `after`.
+    """
+    query = meta.Session.query(model.Package.id).filter(
+        model.Package.state == model.State.ACTIVE)
+    if not (user_obj and user_obj.sysadmin):
+        conditions = [model.Package.private == False]  # noqa: E712
+        if organization_ids:
+            conditions.append(model.Package.owner_org.in_(organization_ids))
+        query = query.filter(or_(*conditions))
+    if after:
+        query = query.filter(model.Package.id > after)
+    return query.order_by(model.Package.id)
+
+
+def _access_request_dict(row):
+    access_request = dict(row)
+    for key in ['created', 'modified']:
+        if access_request.get(key):
+            access_request[key] = access_request[key].isoformat()
+    return access_request
+
+
+def create_access_request(resource_id, package_id, user_id, message):
+    """Insert a pending request, raises sqlalchemy IntegrityError if the
+    user already has one for the resource.
+    """
+    access_request = {
+        'id': _types.make_uuid(),
+        'resource_id': resource_id,
+        'package_id': package_id,
+        'user_id': user_id,
+        'message': message,
+        'status': 'pending',
+        'created': datetime.datetime.utcnow(),
+        'modified': datetime.datetime.utcnow()}
+    meta.Session.execute(access_request_table.insert(), [access_request])
+    return _access_request_dict(access_request)
+
+
+def has_pending_access_request(resource_id, user_id):
+    query = select([access_request_table.c.id]).where(and_(
+        access_request_table.c.resource_id == resource_id,
+        access_request_table.c.user_id == user_id,
+        access_request_table.c.status == 'pending')).limit(1)
+    return meta.Session.execute(query).first() is not None
+
+
+def get_access_request(access_request_id):
+    row = meta.Session.execute(access_request_table.select().where(
+        access_request_table.c.id == access_request_id)).first()
+    return _access_request_dict(row) if row else None
+
+
+def set_access_request_status(access_request_id, status):
+    meta.Session.execute(access_request_table.update().where(
+        access_request_table.c.id == access_request_id
+    ).values(status=status, modified=datetime.datetime.utcnow()))
+
+
+def list_access_requests(filters, limit, offset):
+    """Return (count, [access request dict]) matching the column values
+    in `filters`, newest first.
+    """
+    conditions = [access_request_table.c[column] == value
+                  for column, value in filters.items()]
+    where = and_(*conditions) if conditions else sqlalchemy.true()
+    count = meta.Session.execute(select(
+        [sqlalchemy.func.count()]).select_from(access_request_table).where(where)
+    ).scalar()
+    rows = meta.Session.execute(access_request_table.select().where(where).order_by(
+        access_request_table.c.created.desc()).offset(offset).limit(limit))
+    return count, [_access_request_dict(row) for row in rows]
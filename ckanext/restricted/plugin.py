@@ -7,10 +7,17 @@ import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 from ckanext.restricted import action
 from ckanext.restricted import auth
+from ckanext.restricted import cache
+from ckanext.restricted import cli
 from ckanext.restricted import helpers
 from ckanext.restricted import logic
+from ckanext.restricted import mails
+from ckanext.restricted import metrics
 from ckanext.restricted import validation
 import ckanext.restricted.blueprints as blueprints
+from ckan.common import g
+from flask import Flask, has_request_context
+import json
 
 from logging import getLogger
 log = getLogger(__name__)
@@ -22,13 +29,17 @@ _get_or_bust = ckan.logic.get_or_bust
 class RestrictedPlugin(plugins.SingletonPlugin, DefaultTranslation):
     plugins.implements(plugins.ITranslation)
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.IActions)
     plugins.implements(plugins.ITemplateHelpers)
     plugins.implements(plugins.IAuthFunctions)
     # plugins.implements(plugins.IRoutes, inherit=True)
     plugins.implements(plugins.IBlueprint, inherit=True)
     plugins.implements(plugins.IResourceController, inherit=True)
+    plugins.implements(plugins.IPackageController, inherit=True)
     plugins.implements(plugins.IValidators)
+    plugins.implements(plugins.IClick)
+    plugins.implements(plugins.IMiddleware, inherit=True)
 
 
     # IConfigurer
@@ -37,6 +48,12 @@ class RestrictedPlugin(plugins.SingletonPlugin, DefaultTranslation):
         toolkit.add_public_directory(config_, 'public')
         toolkit.add_resource('fanstatic', 'restricted')
 
+    # IConfigurable
+    def configure(self, config_):
+        cache.configure(config_)
+        mails.configure(config_)
+        metrics.configure(config_)
+
     # IActions
     def get_actions(self):
         return {'user_create': action.restricted_user_create_and_notify,
@@ -44,16 +61,33 @@ class RestrictedPlugin(plugins.SingletonPlugin, DefaultTranslation):
                 'package_show': action.restricted_package_show,
                 'resource_search': action.restricted_resource_search,
                 'package_search': action.restricted_package_search,
-                'restricted_check_access': action.restricted_check_access }
+                'member_create': action.restricted_member_create,
+                'member_delete': action.restricted_member_delete,
+                'package_update': action.restricted_package_update,
+                'restricted_check_access': action.restricted_check_access,
+                'restricted_check_access_batch': action.restricted_check_access_batch,
+                'restricted_accessible_resource_list': action.restricted_accessible_resource_list,
+                'restricted_package_export': action.restricted_package_export,
+                'restricted_resources_for_user': action.restricted_resources_for_user,
+                'restricted_allowed_users_patch': action.restricted_allowed_users_patch,
+                'restricted_access_request_list': action.restricted_access_request_list,
+                'restricted_access_request_approve': action.restricted_access_request_approve,
+                'restricted_access_request_reject': action.restricted_access_request_reject }
 
     # ITemplateHelpers
     def get_helpers(self):
-        return {'restricted_get_user_id': helpers.restricted_get_user_id}
+        return {'restricted_get_user_id': helpers.restricted_get_user_id,
+                'restricted_get_resources_authorization':
+                    helpers.restricted_get_resources_authorization}
 
     # IAuthFunctions
     def get_auth_functions(self):
         return {'resource_show': auth.restricted_resource_show,
-                'resource_view_show': auth.restricted_resource_show}
+                'resource_view_show': auth.restricted_resource_show,
+                'restricted_accessible_resource_list': auth.restricted_accessible_resource_list,
+                'restricted_package_export': auth.restricted_package_export,
+                'restricted_resources_for_user': auth.restricted_resources_for_user,
+                'restricted_access_request_list': auth.restricted_access_request_list}
 
     # IRoutes
     # def before_map(self, map_):
@@ -64,13 +98,60 @@ class RestrictedPlugin(plugins.SingletonPlugin, DefaultTranslation):
     #         action='restricted_request_access_form')
     #     return map_
 
-    # IResourceController
-    def before_update(self, context, current, resource):
-        context['__restricted_previous_value'] = current.get('restricted')
-
-    def after_update(self, context, resource):
-        previous_value = context.get('__restricted_previous_value')
-        logic.restricted_notify_allowed_users(previous_value, resource)
+    # after_create, after_update and after_delete are shared by
+    # IResourceController and IPackageController. Resource changes always
+    # go through package_update, so the access index is only updated
+    # and the new allowed users only notified for datasets.
+    def after_create(self, context, data_dict):
+        if 'package_id' not in data_dict:
+            package_id = data_dict.get('id', data_dict.get('name'))
+            logic.restricted_index_package(package_id)
+            # package_create does not go through package_update
+            logic.restricted_queue_notifications(logic.restricted_collect_grants(
+                {}, {}, logic.restricted_package_resources(package_id)))
+
+    def after_update(self, context, data_dict):
+        if 'package_id' not in data_dict:
+            if data_dict.get('id'):
+                cache.invalidate_package_owner_org(data_dict['id'])
+                cache.invalidate_package_decisions(data_dict['id'])
+            logic.restricted_index_package(data_dict.get('id', data_dict.get('name')))
+            return
+        cache.invalidate_resource_decisions(data_dict.get('id'))
+
+    def after_delete(self, context, data_dict):
+        # IResourceController passes the list of remaining resources
+        if isinstance(data_dict, dict):
+            cache.invalidate_package_owner_org(data_dict.get('id'))
+            cache.invalidate_package_decisions(data_dict.get('id'))
+            logic.restricted_index_package(data_dict.get('id'))
+
+    # IPackageController
+    def before_index(self, pkg_dict):
+        # validated_data_dict is missing with ckan.cache_validated_datasets = false
+        try:
+            package_dict = json.loads(
+                pkg_dict.get('validated_data_dict') or pkg_dict.get('data_dict') or '{}')
+        except ValueError:
+            package_dict = {}
+        # the resource extras are indexed as stored, with the allowed users
+        pkg_dict.pop('res_extras_restricted', None)
+        pkg_dict.update(logic.restricted_index_fields(package_dict))
+        return pkg_dict
+
+    def before_search(self, search_params):
+        # ?ext_restricted_accessible=true only returns datasets with
+        # resources the current user can access
+        extras = search_params.get('extras', {})
+        if not toolkit.asbool(extras.get('ext_restricted_accessible', False)):
+            return search_params
+
+        user_name = getattr(g, 'user', '') if has_request_context() else ''
+        fq = logic.restricted_accessible_filter_query(user_name)
+        if fq:
+            search_params['fq'] = '{} +({})'.format(
+                search_params.get('fq', ''), fq)
+        return search_params
 
     # IBlueprint
     def get_blueprint(self):
@@ -79,3 +160,16 @@ class RestrictedPlugin(plugins.SingletonPlugin, DefaultTranslation):
     # IValidators
     def get_validators(self):
         return {'restricted_username_from_mail': validation.restricted_username_from_mail}
+
+    # IClick
+    def get_commands(self):
+        return cli.get_commands()
+
+    # IMiddleware
+    def make_middleware(self, app, config):
+        # the notifications queued by the actions of a request are sent
+        # together when it ends, and the metrics added to the shared ones
+        if isinstance(app, Flask):
+            app.teardown_request(logic.restricted_dispatch_notifications)
+            app.teardown_request(metrics.flush)
+        return app
@@ -0,0 +1,336 @@
+"""Tests for action.py."""
+import copy
+import json
+
+import pytest
+
+import ckan.plugins.toolkit as toolkit
+from ckan.tests import factories
+from ckan.tests import helpers
+
+from ckanext.restricted import action
+from ckanext.restricted import logic
+
+
+def _baseline_hide_fields(resource, user_name):
+    """The masking of _restricted_resource_list_hide_fields before it was
+    memoized, for a user who cannot edit the dataset.
+    """
+    restricted_resource = dict(resource)
+    restricted_dict = logic.restricted_get_restricted_dict(restricted_resource)
+
+    allowed_users = []
+    for user in restricted_dict.get('allowed_users'):
+        if len(user.strip()) > 0:
+            if user_name == user:
+                allowed_users.append(user_name)
+            else:
+                allowed_users.append(user[0:3] + '*****' + user[-2:])
+
+    new_restricted = json.dumps({
+        'level': restricted_dict.get("level"),
+        'allowed_users': ','.join(allowed_users)})
+    extras_restricted = resource.get('extras', {}).get('restricted', {})
+    if (extras_restricted):
+        restricted_resource['extras'] = dict(
+            resource['extras'], restricted=new_restricted)
+
+    field_restricted_field = resource.get('restricted', {})
+    if (field_restricted_field):
+        restricted_resource['restricted'] = new_restricted
+    return restricted_resource
+
+
+RESOURCES = [
+    {'id': 'no-policy', 'name': 'Resource'},
+    {'id': 'public', 'restricted': json.dumps({'level': 'public', 'allowed_users': ''})},
+    {'id': 'string', 'restricted': json.dumps(
+        {'level': 'only_allowed_users', 'allowed_users': 'allowed_user,other_user, ,me'})},
+    {'id': 'list', 'restricted': json.dumps(
+        {'level': 'registered', 'allowed_users': ['allowed_user', 'me']})},
+    {'id': 'dict', 'restricted': {
+        'level': 'same_organization', 'allowed_users': 'allowed_user'}},
+    {'id': 'extras', 'extras': {'restricted': json.dumps(
+        {'level': 'any_organization', 'allowed_users': 'allowed_user,me'})}},
+    {'id': 'unknown', 'restricted': json.dumps({'level': 'secret', 'allowed_users': 'ab'})},
+    {'id': 'invalid', 'restricted': 'not json'},
+]
+
+
+@pytest.mark.parametrize('user_name', ['', 'me', 'allowed_user'])
+@pytest.mark.parametrize('resource', RESOURCES, ids=[r['id'] for r in RESOURCES])
+def test_masking_matches_baseline(resource, user_name):
+    original = copy.deepcopy(resource)
+
+    masked = action._restricted_resource_hide_fields(resource, user_name)
+
+    assert masked == _baseline_hide_fields(original, user_name)
+    # the input is never modified
+    assert resource == original
+
+
+def test_masking_keeps_own_user_name():
+    resource = RESOURCES[2]
+
+    masked = json.loads(action._restricted_resource_hide_fields(resource, 'me')['restricted'])
+
+    assert masked['allowed_users'] == 'all*****er,oth*****er,me'
+
+
+def test_unchanged_resource_is_not_copied():
+    resource = RESOURCES[0]
+
+    assert action._restricted_resource_hide_fields(resource, 'me') is resource
+
+
+def test_mask_is_memoized_by_policy_value():
+    restricted = json.dumps({'level': 'registered', 'allowed_users': 'user_a'})
+    policy = logic.restricted_get_restricted_policy({'restricted': restricted})
+    same_policy = logic.RestrictedPolicy(policy.level_name, list(policy.users))
+
+    assert action._restricted_mask_policy(policy, 'me') is \
+        action._restricted_mask_policy(same_policy, 'me')
+
+
+@pytest.mark.parametrize('value, expected', [
+    (None, 100), ('', 100), (1, 1), ('1000', 1000)])
+def test_int_param(value, expected):
+    data_dict = {} if value is None else {'limit': value}
+
+    assert action._restricted_int_param(data_dict, 'limit', 100, 1, 1000) == expected
+
+
+@pytest.mark.parametrize('value', [0, -1, '1001', 'ten', '1.5'])
+def test_int_param_is_validated(value):
+    with pytest.raises(toolkit.ValidationError) as e:
+        action._restricted_int_param({'limit': value}, 'limit', 100, 1, 1000)
+
+    assert 'limit' in e.value.error_dict
+
+
+
+class _Row(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+@pytest.fixture
+def check_access(monkeypatch):
+    """Call restricted_check_access for `me` on a resource with
+    `restricted`, counting the lookups of the organizations of the user.
+    """
+    lookups = []
+
+    def check_access(restricted, **data_dict):
+        resource = _Row(id='resource-id', extras={'restricted': restricted})
+        package = _Row(id='package-id', owner_org='org-id', private=False)
+        monkeypatch.setattr(
+            action.restricted_model, 'get_resource_with_package',
+            lambda resource_id, package_id: (resource, package))
+        monkeypatch.setattr(
+            action.cache, 'get_user_organizations',
+            lambda user, loader: lookups.append(user) or {'org-id': 'org'})
+        monkeypatch.setattr(
+            logic, 'restricted_user_can_edit_package', lambda context, id: False)
+        data_dict = dict(data_dict, package_id='package-id', resource_id='resource-id')
+        return action.restricted_check_access(
+            {'__restricted_user_name': 'me'}, data_dict)
+
+    check_access.lookups = lookups
+    return check_access
+
+
+@pytest.mark.parametrize('restricted', [
+    {'level': 'public'}, {'level': 'registered'},
+    {'level': 'only_allowed_users', 'allowed_users': 'me'},
+    {'level': 'same_organization', 'allowed_users': 'other,me'}])
+def test_check_access_token_skips_organizations(check_access, restricted):
+    result = check_access(json.dumps(restricted))
+
+    assert result['success']
+    assert check_access.lookups == []
+
+
+def test_check_access_token_depends_on_organizations(check_access):
+    restricted = json.dumps({'level': 'same_organization', 'allowed_users': 'other'})
+
+    result = check_access(restricted)
+
+    assert result['success']
+    assert check_access.lookups
+
+
+def test_check_access_not_modified(check_access, monkeypatch):
+    restricted = json.dumps({'level': 'only_allowed_users', 'allowed_users': 'me'})
+    token = check_access(restricted)['token']
+    monkeypatch.setattr(logic, 'restricted_check_user_resource_access', None)
+
+    assert check_access(restricted, if_none_match=token) == \
+        {'token': token, 'not_modified': True}
+
+
+def test_check_access_token_changes_with_policy(check_access):
+    token = check_access(json.dumps({'level': 'registered'}))['token']
+
+    assert check_access(json.dumps({'level': 'public'}))['token'] != token
+
+
+@pytest.mark.parametrize('fl, expected', [
+    ('id name', ['id', 'name']),
+    ('id,vocab_restricted_allowed_users,name', ['id', 'name']),
+    (['id', 'restricted', 'data_dict', 'validated_data_dict'], ['id']),
+    ('* score', ['score']),
+    ('vocab_* res_extras_restricted res_extras_restricted_x', []),
+    ('id vocab_restricted_levels', ['id'])])
+def test_strip_search_fields_fl(fl, expected):
+    data_dict = {'q': '*:*', 'fl': fl}
+
+    stripped = action._restricted_strip_search_fields(data_dict)
+
+    assert stripped['fl'] == expected
+    assert stripped['q'] == '*:*'
+    # the input is never modified
+    assert data_dict['fl'] == fl
+
+
+@pytest.mark.parametrize('facet_field', [
+    json.dumps(['tags', 'vocab_restricted_allowed_users', 'res_extras_restricted']),
+    ['tags', 'vocab_restricted_levels', 'restricted']])
+def test_strip_search_fields_facets(facet_field):
+    stripped = action._restricted_strip_search_fields({'facet.field': facet_field})
+
+    assert stripped['facet.field'] == ['tags']
+
+
+@pytest.mark.parametrize('facet_field', ['not json', '"tags"', {'tags': 1}])
+def test_strip_search_fields_invalid_facets(facet_field):
+    with pytest.raises(toolkit.ValidationError):
+        action._restricted_strip_search_fields({'facet.field': facet_field})
+
+
+def test_strip_search_fields_without_fields():
+    data_dict = {'q': 'name:test'}
+
+    assert action._restricted_strip_search_fields(data_dict) is data_dict
+
+
+def _patched(resource, add=(), remove=()):
+    resource = copy.deepcopy(resource)
+    changed = action._restricted_patch_allowed_users(resource, list(add), set(remove))
+    return changed, resource
+
+
+def _allowed_users(resource):
+    return list(logic.restricted_get_restricted_policy(resource).users)
+
+
+@pytest.mark.parametrize('resource', [
+    {'id': 'string', 'restricted': json.dumps(
+        {'level': 'only_allowed_users', 'allowed_users': ' bob,alice'})},
+    {'id': 'dict', 'restricted': {
+        'level': 'only_allowed_users', 'allowed_users': ' bob,alice'}},
+    {'id': 'extras', 'extras': {'restricted': json.dumps(
+        {'level': 'only_allowed_users', 'allowed_users': ' bob,alice'})}}],
+    ids=['string', 'dict', 'extras'])
+class TestPatchAllowedUsers(object):
+
+    def test_add(self, resource):
+        changed, patched = _patched(resource, add=['carol', 'carol'])
+
+        assert changed
+        assert _allowed_users(patched) == ['bob', 'alice', 'carol']
+
+    def test_add_existing_user(self, resource):
+        changed, patched = _patched(resource, add=['bob'])
+
+        assert not changed
+        assert patched == resource
+
+    def test_remove(self, resource):
+        changed, patched = _patched(resource, remove=['bob'])
+
+        assert changed
+        assert _allowed_users(patched) == ['alice']
+
+    def test_remove_missing_user(self, resource):
+        changed, patched = _patched(resource, remove=['carol'])
+
+        assert not changed
+        assert patched == resource
+
+    def test_keeps_format_and_level(self, resource):
+        _, patched = _patched(resource, add=['carol'])
+
+        if 'extras' in resource:
+            assert 'restricted' not in patched
+            restricted = patched['extras']['restricted']
+        else:
+            restricted = patched['restricted']
+        assert isinstance(restricted, type(resource.get(
+            'restricted', resource.get('extras', {}).get('restricted'))))
+        policy = logic.restricted_get_restricted_policy(patched)
+        assert policy.level is logic.RestrictedLevel.ONLY_ALLOWED_USERS
+
+
+def test_patch_allowed_users_of_public_resource():
+    changed, patched = _patched({'id': 'public'}, add=['bob'])
+
+    assert changed
+    assert patched['restricted'] == {'level': 'public', 'allowed_users': 'bob'}
+
+@pytest.mark.ckan_config('ckan.plugins', 'restricted')
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestPackageExport(object):
+
+    @pytest.mark.parametrize('limit', [0, -1, 1001, 'all'])
+    def test_limit_is_validated(self, limit):
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action('restricted_package_export', limit=limit)
+
+    def test_pages(self):
+        datasets = [factories.Dataset() for _ in range(3)]
+
+        first = helpers.call_action('restricted_package_export', limit=2)
+        second = helpers.call_action(
+            'restricted_package_export', limit=2, after=first['next_after'])
+
+        assert len(first['results']) == 2
+        assert len(second['results']) == 1
+        assert second['next_after'] is None
+        assert set(dataset['id'] for dataset in first['results'] + second['results']) == \
+            set(dataset['id'] for dataset in datasets)
+
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'restricted')
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestAllowedUsersPatch(object):
+
+    def test_add_and_remove(self):
+        sysadmin = factories.Sysadmin()
+        dataset = factories.Dataset()
+        resource = factories.Resource(package_id=dataset['id'], restricted=json.dumps(
+            {'level': 'only_allowed_users', 'allowed_users': ' bob,alice'}))
+        unchanged = factories.Resource(package_id=dataset['id'])
+        context = {'user': sysadmin['name']}
+
+        result = helpers.call_action(
+            'restricted_allowed_users_patch', context=context,
+            package_id=dataset['id'], add=['carol'], remove=['bob'])
+
+        assert result['updated_resources'] == [resource['id']]
+        updated = helpers.call_action('resource_show', context=context, id=resource['id'])
+        assert _allowed_users(updated) == ['alice', 'carol']
+
+        result = helpers.call_action(
+            'restricted_allowed_users_patch', context=context,
+            resource_ids=[resource['id'], unchanged['id']], remove=['bob'])
+
+        assert result['updated_resources'] == []
+
+    def test_requires_users(self):
+        dataset = factories.Dataset()
+
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action(
+                'restricted_allowed_users_patch', package_id=dataset['id'])
@@ -0,0 +1,138 @@
+"""Benchmarks for the authorization hot path.
+
+CKAN actions and the database are replaced by local fakes, so only the
+code of the extension is measured. They are skipped in normal test runs,
+run them with:
+
+    pytest --benchmark-only ckanext/restricted/tests/test_benchmark.py
+"""
+import tracemalloc
+
+import flask
+import pytest
+
+from ckanext.restricted import action
+from ckanext.restricted import logic
+
+pytest.importorskip('pytest_benchmark')
+
+RESOURCE_COUNTS = [1, 10, 100, 1000]
+LEVELS = ['public', 'registered', 'any_organization',
+          'same_organization', 'only_allowed_users']
+USER = 'bench_user'
+ORGANIZATIONS = {'org-1': 'organization-1', 'org-2': 'organization-2'}
+
+# package_show results by package id
+_PACKAGES = {}
+
+
+def _make_package(resource_count):
+    package_id = 'package-{}'.format(resource_count)
+    resources = []
+    for i in range(resource_count):
+        level = LEVELS[i % len(LEVELS)]
+        allowed_users = ['user_{}'.format(j) for j in range(i % 7)]
+        if i % 3 == 0:
+            allowed_users.append(USER)
+        resources.append({
+            'id': 'resource-{}'.format(i),
+            'package_id': package_id,
+            'name': 'Resource {}'.format(i),
+            'url': 'https://example.com/{}.csv'.format(i),
+            'restricted': '{{"level": "{0}", "allowed_users": "{1}"}}'.format(
+                level, ','.join(allowed_users))})
+    return {
+        'id': package_id,
+        'name': package_id,
+        'owner_org': 'org-{}'.format(resource_count % 3),
+        'resources': resources}
+
+
+@pytest.fixture(autouse=True)
+def benchmark_only(request):
+    if not request.config.getoption('benchmark_only'):
+        pytest.skip('benchmarks only run with --benchmark-only')
+
+
+@pytest.fixture
+def fake_ckan(monkeypatch):
+    monkeypatch.setattr(
+        logic.authz, 'is_authorized',
+        lambda action_name, context, data_dict=None: {'success': False})
+    monkeypatch.setattr(
+        logic.authz, 'get_user_id_for_username',
+        lambda user_name, allow_none=False: 'id-' + user_name)
+    monkeypatch.setattr(
+        logic, 'restricted_get_user_organizations',
+        lambda user: dict(ORGANIZATIONS))
+    monkeypatch.setattr(
+        action, 'package_show',
+        lambda context, data_dict: _PACKAGES[data_dict['id']])
+    _PACKAGES.clear()
+
+
+@pytest.fixture
+def app():
+    return flask.Flask(__name__)
+
+
+def _package(resource_count):
+    package_dict = _make_package(resource_count)
+    _PACKAGES[package_dict['id']] = package_dict
+    return package_dict
+
+
+def _context():
+    return {'user': USER}
+
+
+def _run(benchmark, app, func):
+    """Benchmark func in a fresh request, like a real page load, and
+    record the memory used by one call.
+    """
+    def in_request():
+        with app.test_request_context():
+            return func()
+
+    tracemalloc.start()
+    in_request()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    benchmark.extra_info['retained_bytes'] = current
+    benchmark.extra_info['peak_bytes'] = peak
+
+    return benchmark(in_request)
+
+
+@pytest.mark.benchmark(group='restricted_check_user_resource_access')
+@pytest.mark.parametrize('resource_count', RESOURCE_COUNTS)
+def test_check_user_resource_access(benchmark, app, fake_ckan, resource_count):
+    package_dict = _package(resource_count)
+
+    def check_all():
+        return [logic.restricted_check_user_resource_access(
+                    USER, resource, package_dict)
+                for resource in package_dict['resources']]
+
+    result = _run(benchmark, app, check_all)
+    assert len(result) == resource_count
+
+
+@pytest.mark.benchmark(group='_restricted_resource_list_hide_fields')
+@pytest.mark.parametrize('resource_count', RESOURCE_COUNTS)
+def test_resource_list_hide_fields(benchmark, app, fake_ckan, resource_count):
+    package_dict = _package(resource_count)
+
+    result = _run(benchmark, app, lambda: action._restricted_resource_list_hide_fields(
+        _context(), package_dict['resources']))
+    assert len(result) == resource_count
+
+
+@pytest.mark.benchmark(group='restricted_package_show')
+@pytest.mark.parametrize('resource_count', RESOURCE_COUNTS)
+def test_package_show(benchmark, app, fake_ckan, resource_count):
+    package_dict = _package(resource_count)
+
+    result = _run(benchmark, app, lambda: action.restricted_package_show(
+        _context(), {'id': package_dict['id']}))
+    assert len(result['resources']) == resource_count
@@ -0,0 +1,76 @@
+"""Tests for blueprints.py."""
+import json
+
+import pytest
+
+from ckan.tests import factories
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'restricted')
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestPackageExport(object):
+
+    def test_anonymous_users_cannot_stream_the_export(self, app):
+        factories.Dataset()
+
+        app.get('/restricted/export.jsonl', status=401)
+
+    def test_logged_in_users_stream_the_export(self, app):
+        user = factories.User()
+        dataset = factories.Dataset()
+
+        response = app.get(
+            '/restricted/export.jsonl',
+            extra_environ={'REMOTE_USER': str(user['name'])}, status=200)
+
+        lines = response.body.splitlines()
+        assert [json.loads(line)['id'] for line in lines] == [dataset['id']]
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'restricted')
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestRequestAccess(object):
+
+    def test_resource_of_another_dataset_is_not_found(self, app):
+        user = factories.User()
+        dataset = factories.Dataset()
+        other_resource = factories.Resource()
+        url = '/dataset/{}/restricted_request_access/{}'.format(
+            dataset['name'], other_resource['id'])
+
+        app.post(
+            url, data={
+                'save': '', 'package_name': dataset['name'],
+                'resource_id': other_resource['id'], 'message': 'Hello'},
+            extra_environ={'REMOTE_USER': str(user['name'])}, status=404)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'restricted')
+@pytest.mark.ckan_config('ckanext.restricted.metrics_enabled', 'true')
+@pytest.mark.ckan_config('ckanext.restricted.metrics_token', 'secret-token')
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestMetrics(object):
+
+    def test_anonymous_users_cannot_read_the_metrics(self, app):
+        app.get('/restricted/metrics', status=403)
+
+    def test_users_cannot_read_the_metrics(self, app):
+        user = factories.User()
+
+        app.get('/restricted/metrics',
+                extra_environ={'REMOTE_USER': str(user['name'])}, status=403)
+
+    def test_sysadmins_read_the_metrics(self, app):
+        sysadmin = factories.Sysadmin()
+
+        response = app.get(
+            '/restricted/metrics',
+            extra_environ={'REMOTE_USER': str(sysadmin['name'])}, status=200)
+
+        assert 'restricted_resource_decisions_total' in response.body
+
+    def test_scrapers_read_the_metrics_with_the_token(self, app):
+        app.get('/restricted/metrics',
+                headers={'Authorization': 'Bearer wrong-token'}, status=403)
+        app.get('/restricted/metrics',
+                headers={'Authorization': 'Bearer secret-token'}, status=200)
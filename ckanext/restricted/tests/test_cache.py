@@ -0,0 +1,114 @@
+"""Tests for the shared Redis cache of cache.py."""
+import pytest
+from redis.exceptions import ConnectionError
+
+from ckanext.restricted import cache
+
+fakeredis = pytest.importorskip('fakeredis')
+
+CONFIG = {
+    'ckanext.restricted.redis_cache': 'true',
+    'ckanext.restricted.organization_cache_ttl': '60',
+    'ckanext.restricted.decision_cache_ttl': '60'}
+
+
+class _BrokenRedis(object):
+    def __getattr__(self, name):
+        def fail(*args, **kwargs):
+            raise ConnectionError('Redis is down')
+        return fail
+
+
+@pytest.fixture
+def configure(monkeypatch):
+    def configure(connection):
+        monkeypatch.setattr(cache, 'connect_to_redis', lambda: connection)
+        cache.configure(CONFIG)
+    yield configure
+    cache.configure({})
+
+
+class _Loader(object):
+    def __init__(self, value):
+        self.value = value
+        self.calls = 0
+
+    def __call__(self, key):
+        self.calls += 1
+        return self.value
+
+
+def test_entries_are_shared(configure):
+    connection = fakeredis.FakeStrictRedis()
+    configure(connection)
+    loader = _Loader({'org-id': 'org-name'})
+
+    assert cache.get_user_organizations('user', loader) == {'org-id': 'org-name'}
+    # another process only sees the entries in Redis
+    cache.organization_cache.clear()
+    assert cache.get_user_organizations('user', loader) == {'org-id': 'org-name'}
+    assert loader.calls == 1
+
+
+def test_bumped_versions_invalidate_entries(configure):
+    configure(fakeredis.FakeStrictRedis())
+    loader = _Loader({'success': True})
+    key = ('user', 'resource-id', '2020-01-01T00:00:00', 'package-id')
+
+    cache.get_resource_decision(key, loader)
+    cache.invalidate_user_organizations('user')
+    cache.get_resource_decision(key, loader)
+    cache.invalidate_resource_decisions('resource-id')
+    cache.get_resource_decision(key, loader)
+    cache.get_resource_decision(key, loader)
+    cache.invalidate_package_decisions('package-id')
+    cache.get_resource_decision(key, loader)
+    cache.invalidate_package_decisions('other-package-id')
+    cache.get_resource_decision(key, loader)
+    cache.invalidate_decisions()
+    cache.get_resource_decision(key, loader)
+
+    assert loader.calls == 5
+
+
+def test_local_decisions_are_invalidated():
+    cache.configure({'ckanext.restricted.decision_cache_ttl': '60'})
+    loader = _Loader({'success': True})
+    key = ('user', 'resource-id', '2020-01-01T00:00:00', 'package-id')
+    other_key = ('user', 'other-resource-id', '2020-01-01T00:00:00',
+                 'other-package-id')
+    try:
+        cache.get_resource_decision(key, loader)
+        cache.get_resource_decision(other_key, loader)
+        cache.invalidate_resource_decisions('resource-id')
+        cache.get_resource_decision(key, loader)
+        cache.invalidate_package_decisions('package-id')
+        cache.get_resource_decision(key, loader)
+        cache.get_resource_decision(other_key, loader)
+    finally:
+        cache.configure({})
+
+    assert loader.calls == 4
+
+
+def test_falls_back_when_redis_is_not_available(configure):
+    configure(_BrokenRedis())
+    loader = _Loader({})
+
+    cache.get_user_organizations('user', loader)
+    cache.get_user_organizations('user', loader)
+
+    assert cache._shared_caches == {}
+    assert loader.calls == 1
+
+
+def test_falls_back_when_redis_fails(configure):
+    connection = fakeredis.FakeStrictRedis()
+    configure(connection)
+    cache._shared_caches['organizations'].connection = _BrokenRedis()
+    loader = _Loader({})
+
+    cache.get_user_organizations('user', loader)
+    cache.get_user_organizations('user', loader)
+
+    assert loader.calls == 1
@@ -0,0 +1,111 @@
+"""Tests for jobs.py."""
+import pytest
+import socket
+
+from ckanext.restricted import jobs
+
+controller = pytest.importorskip('aiosmtpd.controller')
+
+
+class _Handler(object):
+    def __init__(self):
+        self.envelopes = []
+        self.sessions = set()
+
+    async def handle_DATA(self, server, session, envelope):
+        self.envelopes.append(envelope)
+        self.sessions.add(id(session))
+        return '250 OK'
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def smtp_server(ckan_config, monkeypatch):
+    handler = _Handler()
+    server = controller.Controller(
+        handler, hostname='127.0.0.1', port=_free_port())
+    server.start()
+    monkeypatch.setitem(
+        ckan_config, 'smtp.test_server',
+        '{}:{}'.format(server.hostname, server.port))
+    monkeypatch.setitem(ckan_config, 'smtp.mail_from', 'ckan@example.com')
+    yield handler
+    server.stop()
+
+
+def test_send_mails_uses_one_connection(smtp_server):
+    messages = [
+        jobs.mail_message('User {}'.format(i), 'user{}@example.com'.format(i),
+                          'Subject', 'Body')
+        for i in range(5)]
+
+    failed = jobs.send_mails(messages, retries=0)
+
+    assert failed == []
+    assert len(smtp_server.envelopes) == 5
+    assert len(smtp_server.sessions) == 1
+    assert smtp_server.envelopes[0].rcpt_tos == ['user0@example.com']
+
+
+def test_send_mails_keeps_headers(smtp_server):
+    jobs.send_mails([jobs.mail_message(
+        'User', 'user@example.com', 'Subject', 'Body',
+        headers={'reply-to': 'requester@example.com'})], retries=0)
+
+    content = smtp_server.envelopes[0].content.decode('utf-8')
+    assert 'reply-to: requester@example.com' in content.lower()
+
+
+def test_send_mails_returns_failed_messages(ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config, 'smtp.test_server', '127.0.0.1:1')
+    messages = [jobs.mail_message('User', 'user@example.com', 'Subject', 'Body')]
+
+    assert jobs.send_mails(messages, retries=0) == messages
+
+
+@pytest.mark.ckan_config('ckanext.restricted.async_mail', 'false')
+def test_enqueue_mails_sends_synchronously(smtp_server):
+    jobs.enqueue_mails([jobs.mail_message(
+        'User', 'user@example.com', 'Subject', 'Body')])
+
+    assert len(smtp_server.envelopes) == 1
+
+
+class _ResetConnection(object):
+    """SMTP connection reset after the first mail."""
+
+    def __init__(self):
+        self.sent = []
+
+    def sendmail(self, mail_from, recipients, body):
+        if self.sent:
+            raise ConnectionResetError('Connection reset by peer')
+        self.sent.append(recipients)
+
+    def quit(self):
+        raise OSError('Socket closed')
+
+
+def test_send_mails_retries_after_socket_errors(ckan_config, monkeypatch):
+    connections = []
+
+    def connect():
+        connections.append(_ResetConnection())
+        return connections[-1]
+
+    monkeypatch.setattr(jobs, '_smtp_connect', connect)
+    monkeypatch.setitem(ckan_config, 'ckanext.restricted.mail_retry_backoff', '0')
+    messages = [
+        jobs.mail_message('User', 'user{}@example.com'.format(i), 'Subject', 'Body')
+        for i in range(3)]
+
+    failed = jobs.send_mails(messages, retries=1)
+
+    assert [connection.sent for connection in connections] == [
+        [['user0@example.com']], [['user1@example.com']]]
+    assert failed == messages[2:]
@@ -0,0 +1,229 @@
+"""Tests for logic.py."""
+import json
+
+import pytest
+
+from ckanext.restricted import logic
+
+
+def _resource(restricted):
+    return {'id': 'resource-id', 'restricted': restricted}
+
+
+def test_policy_from_json_string():
+    policy = logic.restricted_get_restricted_policy(_resource(json.dumps(
+        {'level': 'only_allowed_users', 'allowed_users': 'user_a,user_b'})))
+
+    assert policy.level is logic.RestrictedLevel.ONLY_ALLOWED_USERS
+    assert policy.users == ('user_a', 'user_b')
+    assert policy.allowed_users == frozenset(['user_a', 'user_b'])
+
+
+def test_policy_from_dict_and_extras():
+    restricted = {'level': 'registered', 'allowed_users': ['user_a']}
+
+    from_dict = logic.restricted_get_restricted_policy(_resource(restricted))
+    from_extras = logic.restricted_get_restricted_policy(
+        {'extras': {'restricted': json.dumps(restricted)}})
+
+    assert from_dict.level is logic.RestrictedLevel.REGISTERED
+    assert from_dict == from_extras
+    assert hash(from_dict) == hash(from_extras)
+
+
+@pytest.mark.parametrize('resource', [
+    None, {}, _resource(''), _resource('not json'), _resource('[1, 2]'),
+    _resource({}), _resource(json.dumps({'level': None}))])
+def test_public_policy(resource):
+    policy = logic.restricted_get_restricted_policy(resource)
+
+    assert policy.level is logic.RestrictedLevel.PUBLIC
+    assert not [user for user in policy.users if user.strip()]
+
+
+def test_unknown_level():
+    policy = logic.restricted_get_restricted_policy(_resource('{"level": "secret"}'))
+
+    assert policy.level is None
+    assert policy.level_name == 'secret'
+
+
+@pytest.mark.parametrize('restricted', [
+    {'level': ['x']},
+    {'level': {'x': 1}},
+    {'level': 'only_allowed_users', 'allowed_users': ['user_a', None, 1, ['x']]},
+    {'level': 'only_allowed_users', 'allowed_users': 7}])
+def test_malformed_policy_does_not_raise(restricted):
+    policy = logic.restricted_get_restricted_policy(_resource(json.dumps(restricted)))
+
+    assert all(isinstance(user, str) for user in policy.users)
+    assert logic.restricted_get_restricted_policy(_resource(restricted)) == policy
+
+
+def test_malformed_level_is_unknown():
+    policy = logic.restricted_get_restricted_policy(_resource('{"level": ["x"]}'))
+
+    assert policy.level is None
+
+
+def test_policy_is_memoized():
+    restricted = json.dumps({'level': 'registered', 'allowed_users': 'user_a'})
+
+    assert logic.restricted_get_restricted_policy(_resource(restricted)) is \
+        logic.restricted_get_restricted_policy(_resource(restricted))
+
+
+def test_policy_is_immutable():
+    with pytest.raises(AttributeError):
+        logic.PUBLIC_POLICY.level = logic.RestrictedLevel.REGISTERED
+
+
+def test_policy_equality():
+    assert logic.RestrictedPolicy('registered', ['a', 'b']) == \
+        logic.RestrictedPolicy('registered', ('a', 'b'))
+    assert logic.RestrictedPolicy('registered', ['a', 'b']) != \
+        logic.RestrictedPolicy('registered', ['b', 'a'])
+    assert logic.RestrictedPolicy('registered', []) != \
+        logic.RestrictedPolicy('public', [])
+
+
+def _allowed(users, level='only_allowed_users'):
+    return {'level': level, 'allowed_users': users}
+
+
+def test_allowed_users_added():
+    previous = {'restricted': json.dumps(_allowed('user_a'))}
+    updated = {'id': 'resource-id', 'restricted': _allowed('user_a, user_b,')}
+
+    assert logic.restricted_allowed_users_added(previous, updated) == \
+        frozenset(['user_b'])
+    assert logic.restricted_allowed_users_added(None, updated) == \
+        frozenset(['user_a', 'user_b'])
+    assert logic.restricted_allowed_users_added(updated, previous) == frozenset()
+
+
+def test_allowed_users_added_from_extras():
+    previous = {'extras': {'restricted': _allowed('user_a')}}
+    updated = {'extras': {'restricted': json.dumps(_allowed('user_a,user_b'))}}
+
+    assert logic.restricted_allowed_users_added(previous, updated) == \
+        frozenset(['user_b'])
+
+
+def test_collect_grants():
+    updated = [
+        {'id': 'unchanged', 'restricted': _allowed('user_a')},
+        {'id': 'no-extras', 'restricted': _allowed('user_a')},
+        {'id': 'new', 'restricted': json.dumps(_allowed('user_a,user_b'))},
+        {'id': 'public', 'restricted': ''}]
+    previous = {
+        # the extras stored with the dict restricted value
+        'unchanged': {'restricted': _allowed('user_a')},
+        # a resource saved without extras, see restricted_package_update
+        'no-extras': {},
+        'public': {}}
+    grants = {'user_b': [{'id': 'earlier'}]}
+
+    result = logic.restricted_collect_grants(grants, previous, updated)
+
+    assert result is grants
+    assert [resource['id'] for resource in grants['user_a']] == ['no-extras', 'new']
+    assert [resource['id'] for resource in grants['user_b']] == ['earlier', 'new']
+
+
+@pytest.fixture
+def index_config(monkeypatch):
+    config = {'ckanext.restricted.index_secret': 'index-secret'}
+    monkeypatch.setattr(logic, 'config', config)
+    return config
+
+
+def test_index_fields(index_config):
+    package_dict = {'id': 'package-id', 'resources': [
+        _resource(json.dumps(_allowed('user_a, user_b'))),
+        _resource(_allowed('user_a', level='registered')),
+        # the allowed users of public resources grant nothing
+        _resource(_allowed('user_c', level='public')),
+        _resource('{"level": "secret"}')]}
+
+    fields = logic.restricted_index_fields(package_dict)
+
+    assert fields['vocab_restricted_levels'] == \
+        ['only_allowed_users', 'public', 'registered', 'secret']
+    assert fields['vocab_restricted_allowed_users'] == sorted(
+        logic.restricted_user_index_token(user) for user in ['user_a', 'user_b'])
+    assert not any('user_' in token for token in fields['vocab_restricted_allowed_users'])
+
+
+def test_index_token_depends_on_secret(index_config):
+    token = logic.restricted_user_index_token('user_a')
+    index_config['ckanext.restricted.index_secret'] = 'other-secret'
+
+    assert logic.restricted_user_index_token('user_a') != token
+
+
+def test_index_token_falls_back_to_session_secret(index_config):
+    del index_config['ckanext.restricted.index_secret']
+    index_config['beaker.session.secret'] = 'session-secret'
+
+    assert logic.restricted_user_index_token('user_a')
+
+
+def test_allowed_users_are_not_indexed_without_secret(index_config):
+    index_config.clear()
+    package_dict = {'id': 'package-id', 'resources': [
+        _resource(_allowed('user_a'))]}
+
+    fields = logic.restricted_index_fields(package_dict)
+
+    assert logic.restricted_user_index_token('user_a') is None
+    assert fields['vocab_restricted_levels'] == ['only_allowed_users']
+    assert fields['vocab_restricted_allowed_users'] == []
+
+
+@pytest.fixture
+def filter_query(monkeypatch, index_config):
+    """restricted_accessible_filter_query for a user member of org-a and
+    editor of org-b.
+    """
+    monkeypatch.setattr(logic.authz, 'is_sysadmin', lambda user: user == 'admin')
+    monkeypatch.setattr(
+        logic.authz, 'get_user_id_for_username',
+        lambda user, allow_none=False: 'id-' + user)
+    monkeypatch.setattr(
+        logic.cache, 'get_user_organizations',
+        lambda user, loader: {'org-a': 'a', 'org-b': 'b'})
+    monkeypatch.setattr(
+        logic.logic, 'get_action',
+        lambda name: lambda context, data_dict: [{'id': 'org-b'}])
+    return logic.restricted_accessible_filter_query
+
+
+def test_filter_query_for_anonymous_users(filter_query):
+    assert filter_query('') == 'vocab_restricted_levels:public'
+
+
+def test_filter_query_for_sysadmins(filter_query):
+    assert filter_query('admin') is None
+
+
+def test_filter_query_for_users(filter_query):
+    conditions = filter_query('user_a').split(' OR ')
+
+    assert conditions[:3] == [
+        'vocab_restricted_levels:public',
+        'vocab_restricted_levels:registered',
+        'vocab_restricted_allowed_users:"{}"'.format(
+            logic.restricted_user_index_token('user_a'))]
+    assert 'vocab_restricted_levels:any_organization' in conditions
+    assert 'creator_user_id:"id-user_a"' in conditions
+    assert 'owner_org:("org-b")' in conditions
+    # the user name itself is never matched in the index
+    assert not any(condition.startswith('vocab_') and 'user_a' in condition
+                   for condition in conditions)
+
+
+def test_filter_query_without_secret(filter_query, index_config):
+    index_config.clear()
+
+    assert 'vocab_restricted_allowed_users' not in filter_query('user_a')
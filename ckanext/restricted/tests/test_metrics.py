@@ -0,0 +1,78 @@
+"""Tests for the metrics shared through Redis of metrics.py."""
+import pytest
+from redis.exceptions import ConnectionError
+
+from ckanext.restricted import metrics
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+class _BrokenRedis(object):
+    def __getattr__(self, name):
+        def fail(*args, **kwargs):
+            raise ConnectionError('Redis is down')
+        return fail
+
+
+@pytest.fixture
+def connection(monkeypatch):
+    connection = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(metrics, 'connect_to_redis', lambda: connection)
+    metrics.configure({'ckanext.restricted.metrics_enabled': 'true'})
+    yield connection
+    metrics.configure({})
+
+
+def _lines(name):
+    return [line for line in metrics.render().splitlines()
+            if line.startswith(name)]
+
+
+def test_values_of_all_processes_are_added(connection):
+    metrics.decisions.inc(level='public', outcome='allowed')
+    metrics.flush()
+    # the same in another process
+    metrics.decisions.inc(level='public', outcome='allowed')
+    metrics.decisions.inc(level='registered', outcome='denied')
+
+    assert _lines('restricted_resource_decisions_total') == [
+        'restricted_resource_decisions_total{level="public",outcome="allowed"} 2',
+        'restricted_resource_decisions_total{level="registered",outcome="denied"} 1']
+    # rendering flushed the values of this process
+    assert metrics.decisions.take() == {}
+
+
+def test_histogram_buckets_are_cumulative(connection):
+    metrics.durations.observe(0.0007, function='f')
+    metrics.flush()
+    metrics.durations.observe(3, function='f')
+    metrics.durations.observe(20, function='f')
+
+    lines = _lines('restricted_function_duration_seconds')
+
+    assert 'restricted_function_duration_seconds_bucket{function="f",le="0.0005"} 0' in lines
+    assert 'restricted_function_duration_seconds_bucket{function="f",le="0.001"} 1' in lines
+    assert 'restricted_function_duration_seconds_bucket{function="f",le="5"} 2' in lines
+    assert 'restricted_function_duration_seconds_bucket{function="f",le="+Inf"} 3' in lines
+    assert 'restricted_function_duration_seconds_count{function="f"} 3' in lines
+    assert 'restricted_function_duration_seconds_sum{function="f"} 23.0007' in lines
+
+
+def test_values_are_kept_when_redis_fails(connection):
+    metrics.decisions.inc(level='public', outcome='allowed')
+    metrics._redis = _BrokenRedis()
+    metrics.flush()
+    metrics._redis = connection
+
+    assert _lines('restricted_resource_decisions_total') == [
+        'restricted_resource_decisions_total{level="public",outcome="allowed"} 1']
+
+
+def test_nothing_is_recorded_when_disabled():
+    metrics.configure({})
+
+    metrics.decisions.inc(level='public', outcome='allowed')
+    metrics.durations.observe(1, function='f')
+
+    assert metrics.decisions.take() == {}
+    assert metrics.durations.take() == {}
@@ -0,0 +1,103 @@
+"""Tests for model.py."""
+import json
+
+import pytest
+
+import ckan.plugins.toolkit as toolkit
+from ckan.tests import factories
+from ckan.tests import helpers
+
+from ckanext.restricted import model as restricted_model
+
+
+class _Engine(object):
+    """Engine whose tables exist once `exists` is set."""
+
+    def __init__(self):
+        self.exists = False
+        self.lookups = 0
+        self.dialect = self
+
+    def connect(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def has_table(self, connection, table_name):
+        self.lookups += 1
+        return self.exists
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    engine = _Engine()
+    monkeypatch.setattr(restricted_model.meta, 'engine', engine)
+    monkeypatch.setattr(restricted_model, '_existing_tables', {})
+    return engine
+
+
+def test_missing_table_is_looked_up_again(engine, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(restricted_model.time, 'time', lambda: now[0])
+    table = restricted_model.resource_policy_table
+
+    assert not restricted_model.table_exists(table)
+    assert not restricted_model.table_exists(table)
+    assert engine.lookups == 1
+
+    # created by init-db in another process
+    engine.exists = True
+    now[0] += restricted_model.MISSING_TABLE_RECHECK
+    assert restricted_model.table_exists(table)
+    assert restricted_model.table_exists(table)
+    assert engine.lookups == 2
+
+
+def _restricted(level):
+    return json.dumps({'level': level, 'allowed_users': ''})
+
+
+@pytest.fixture
+def access_index():
+    restricted_model._existing_tables.clear()
+    restricted_model.init_tables()
+    yield
+    restricted_model._existing_tables.clear()
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'restricted')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'access_index')
+class TestAccessibleResourceList(object):
+
+    def _list(self, user, **data_dict):
+        return helpers.call_action(
+            'restricted_accessible_resource_list',
+            context={'user': user['name'], 'ignore_auth': True},
+            **data_dict)
+
+    def test_private_datasets_are_hidden_from_non_members(self):
+        user = factories.User()
+        member = factories.User()
+        organization = factories.Organization(
+            users=[{'name': member['name'], 'capacity': 'member'}])
+        public = factories.Dataset(owner_org=organization['id'])
+        private = factories.Dataset(owner_org=organization['id'], private=True)
+        visible = factories.Resource(
+            package_id=public['id'], restricted=_restricted('registered'))
+        hidden = factories.Resource(
+            package_id=private['id'], restricted=_restricted('registered'))
+
+        assert self._list(user)['results'] == [visible['id']]
+        assert self._list(user, include_public=True)['results'] == [visible['id']]
+        assert sorted(self._list(member)['results']) == \
+            sorted([visible['id'], hidden['id']])
+
+    @pytest.mark.parametrize('data_dict', [
+        {'limit': 0}, {'limit': 'ten'}, {'offset': -1}])
+    def test_paging_is_validated(self, data_dict):
+        with pytest.raises(toolkit.ValidationError):
+            self._list(factories.User(), **data_dict)
@@ -1,7 +1,9 @@
-from ckantoolkit import _
+from ckantoolkit import _, config
+import ckantoolkit as toolkit
 import json
 from ckanext.scheming.validation import scheming_validator
 import ckan.model as model
+from sqlalchemy import func
 from sqlalchemy.sql.expression import or_
 
 from ckan.model import meta
@@ -25,18 +27,13 @@ def restricted_username_from_mail(field, schema):
 
         if restricted_data.get('allowed_users'):
             allowed_users = restricted_data['allowed_users'].split(',')
+            usernames_from_mail = _restricted_usernames_from_mails(
+                [username for username in allowed_users if username.find('@') > 0])
             new_allowed_users = []
             for username in allowed_users:
                 new_name = username
                 if username.find('@') > 0:
-                    new_name = ''
-                    query = _restricted_user_search(username)
-                    query = query.filter(model.User.state != model.State.DELETED)
-                    query = query.limit(1)
-
-                    for user in query.all():
-                        new_name = user.name
-                        break
+                    new_name = usernames_from_mail.get(username, '')
                 if new_name and new_name not in new_allowed_users:
                     logger.debug("restricted_username_from_mail: replacing {0} => {1}".format(username, new_name))
                     new_allowed_users += [new_name]
@@ -45,6 +42,43 @@ def restricted_username_from_mail(field, schema):
 
     return validator
 
+def _restricted_usernames_from_mails(emails):
+    '''Map every email to a user name with a single query.
+
+    Emails are matched exactly (case insensitive), which uses the
+    lower(email) index created by `ckan restricted init-db`. The old partial
+    match on name, fullname and email is used for the remaining emails
+    when ckanext.restricted.allowed_users_partial_match is enabled.
+    '''
+    usernames = {}
+    if not emails:
+        return usernames
+
+    lower_emails = {}
+    for email in emails:
+        lower_emails.setdefault(email.strip().lower(), []).append(email)
+    query = meta.Session.query(model.User.name, model.User.email)
+    query = query.filter(func.lower(model.User.email).in_(lower_emails.keys()))
+    query = query.filter(model.User.state != model.State.DELETED)
+    for name, email in query.all():
+        for original_email in lower_emails.get(email.lower(), []):
+            usernames.setdefault(original_email, name)
+
+    if toolkit.asbool(config.get(
+            'ckanext.restricted.allowed_users_partial_match', False)):
+        for email in emails:
+            if email in usernames:
+                continue
+            query = _restricted_user_search(email)
+            query = query.filter(model.User.state != model.State.DELETED)
+            query = query.limit(1)
+
+            for user in query.all():
+                usernames[email] = user.name
+                break
+
+    return usernames
+
 def _restricted_user_search(querystr):
     '''Search name, fullname, email. '''
     query = meta.Session.query(model.User)